@@ -12,15 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import markdown
 import re
-from google_workspace import create_message, update_message, download_chat_attachment
-from vertex_ai import IAiAgentHandler, IAiAgentUiRender
+from google_workspace import create_message, update_message, async_create_message, async_update_message, download_chat_attachment, ChatWriteCoalescer, PendingChatMessage, chat_write_rate_limiter
+from env import CHAT_ASYNC_CLIENT, CHAT_WRITE_COALESCING_WINDOW_SECONDS, ATTACHMENT_DOWNLOAD_CONCURRENCY
+from vertex_ai import IAiAgentHandler, IAiAgentUiRender, inline_handler
 from typing import Any
 
 # Error message to display when something goes wrong
 ERROR_MESSAGE = "❌ Something went wrong"
 
+# Message to display when a newer request took over
+CANCELLED_MESSAGE = "⏹️ Cancelled"
+
 def snake_to_user_readable(snake_case_string="") -> str:
     """Converts a snake_case_string to a user-readable Title Case string."""
     return snake_case_string.replace('_', ' ').title()
@@ -34,14 +39,17 @@ class AgentCommon(IAiAgentHandler):
         super().__init__(ui_render)
         self.turn_card_sections = []   
 
+    @inline_handler
     def extract_content_from_input(self, input) -> dict:
         # For non-Chat host apps, the input is a simple text string
         return { "role": "user", "parts": [{ "text": input }] }
     
+    @inline_handler
     def final_answer(self, author: str, text: str, success: bool, failure: bool):
         """Adds the final answer section to the turn card sections."""
         self.add_section(section=self.build_section(author=author, text=text, widgets=[], success=success, failure=failure))
 
+    @inline_handler
     def function_calling_initiation(self, author: str, name: str) -> Any:
         """Adds a function calling initiation section to the turn card sections."""
         return self.add_section(section=self.build_section(
@@ -65,6 +73,7 @@ class AgentCommon(IAiAgentHandler):
             )
         )
 
+    @inline_handler
     def function_calling_failure(self, name: str, output_id: str):
         """Updates the function calling section with a failure status."""
         self.update_section(
@@ -78,6 +87,20 @@ class AgentCommon(IAiAgentHandler):
             )
         )
 
+    @inline_handler
+    def function_calling_cancellation(self, name: str, output_id: str):
+        """Updates the function calling section with a cancelled status."""
+        self.update_section(
+            index=output_id,
+            section=self.build_section(
+                author=name,
+                text=CANCELLED_MESSAGE,
+                widgets=[],
+                success=False,
+                failure=True
+            )
+        )
+
     # ------ Utility functions
 
     def add_section(self, section) -> int:
@@ -111,26 +134,61 @@ class AgentChat(IAiAgentHandler):
 
     # ----- IAiAgentHandler interface implementation
 
-    def extract_content_from_input(self, input) -> dict:
+    def __init__(self, ui_render: IAiAgentUiRender, space_name: str = None):
+        super().__init__(ui_render)
+        # The Chat space to write to, defaults to the space configured for the current request
+        self.space_name = space_name
+        # Successive writes of the same message are merged, only the latest state is sent within the space write rate
+        self.writes = ChatWriteCoalescer(CHAT_WRITE_COALESCING_WINDOW_SECONDS, self.create_chat_message, self.update_chat_message, chat_write_rate_limiter)
+
+    async def extract_content_from_input(self, input) -> dict:
         # For Chat host apps, the input can contain text and attachments
         parts = [{ "text": input.get("text") }]
-        if "attachment" in input:
-            for attachment in input.get("attachment"):
-                attachmentBase64Data = download_chat_attachment(attachment.get("attachmentDataRef").get("resourceName"))
-                inline_data_part = { "inline_data": {
-                    "mime_type": attachment.get("contentType"),
-                    "data": attachmentBase64Data
-                }}
-                parts.append(inline_data_part)
+        attachments = input.get("attachment", [])
+        # Attachments are downloaded in parallel, with a limit on concurrent downloads
+        semaphore = asyncio.Semaphore(ATTACHMENT_DOWNLOAD_CONCURRENCY)
+        async def download(attachment) -> str:
+            async with semaphore:
+                return await asyncio.to_thread(download_chat_attachment, attachment.get("attachmentDataRef").get("resourceName"))
+        results = await asyncio.gather(*[download(attachment) for attachment in attachments], return_exceptions=True)
+        failed_attachment_names = []
+        for attachment, result in zip(attachments, results):
+            if isinstance(result, Exception):
+                # Answer without the attachment rather than failing the whole turn
+                print(f"Error occurred while downloading attachment {attachment.get('contentName')}: {result}")
+                failed_attachment_names.append(attachment.get("contentName", "Unknown"))
+                continue
+            inline_data_part = { "inline_data": {
+                "mime_type": attachment.get("contentType"),
+                "data": result
+            }}
+            parts.append(inline_data_part)
+        if failed_attachment_names:
+            await self.writes.create(
+                message=self.build_message(
+                    author="Agent",
+                    text=f"⚠️ I could not read {', '.join(f'**{name}**' for name in failed_attachment_names)}, I will answer without.",
+                    cards_v2=[],
+                    success=False,
+                    failure=True
+                ),
+                space_name=self.space_name,
+                coalesce=False
+            )
         return { "role": "user", "parts": parts }
 
-    def final_answer(self, author: str, text: str, success: bool, failure: bool):
+    async def final_answer(self, author: str, text: str, success: bool, failure: bool):
         """Sends the final answer as a Chat message."""
-        create_message(message=self.build_message(author=author, text=text, cards_v2=[], success=success, failure=failure))
+        await self.writes.create(
+            message=self.build_message(author=author, text=text, cards_v2=[], success=success, failure=failure),
+            space_name=self.space_name,
+            # Final answers are never updated
+            coalesce=False
+        )
 
-    def function_calling_initiation(self, author: str, name: str) -> Any:
-        """Sends a function calling initiation message in Chat and returns the message name as output ID."""
-        return create_message(message=self.build_message(
+    async def function_calling_initiation(self, author: str, name: str) -> Any:
+        """Sends a function calling initiation message in Chat and returns the pending message as output ID."""
+        return await self.writes.create(space_name=self.space_name, message=self.build_message(
             author=name,
             text=f"Working on **{snake_to_user_readable(author)}**'s request...",
             cards_v2=[],
@@ -138,11 +196,12 @@ class AgentChat(IAiAgentHandler):
             failure=False
         ))
 
-    def function_calling_completion(self, author: str, name: str, response, output_id):
+    async def function_calling_completion(self, author: str, name: str, response, output_id: PendingChatMessage):
         """Updates the function calling message in Chat with the completion response."""
-        widgets = self.ui_render.get_agent_response_widgets(name=name, response=response)
-        update_message(
-            name=output_id,
+        # Rendering can check remote resources so it's kept off the event loop
+        widgets = await asyncio.to_thread(self.ui_render.get_agent_response_widgets, name=name, response=response)
+        await self.writes.update(
+            pending=output_id,
             message=self.build_message(
                 author=name,
                 text="",
@@ -152,10 +211,10 @@ class AgentChat(IAiAgentHandler):
             )
         )
 
-    def function_calling_failure(self, name: str, output_id: str):
+    async def function_calling_failure(self, name: str, output_id: PendingChatMessage):
         """Updates the function calling section with a failure status."""
-        update_message(
-            name=output_id,
+        await self.writes.update(
+            pending=output_id,
             message=self.build_message(
                 author=name,
                 text=ERROR_MESSAGE,
@@ -165,8 +224,37 @@ class AgentChat(IAiAgentHandler):
             )
         )
 
+    async def function_calling_cancellation(self, name: str, output_id: PendingChatMessage):
+        """Updates the function calling message in Chat with a cancelled status."""
+        await self.writes.update(
+            pending=output_id,
+            message=self.build_message(
+                author=name,
+                text=CANCELLED_MESSAGE,
+                cards_v2=[],
+                success=False,
+                failure=True
+            )
+        )
+
+    async def complete_turn(self):
+        """Sends the Chat message writes that are still pending."""
+        await self.writes.flush()
+
     # ------ Utility functions
 
+    async def create_chat_message(self, message, space_name: str = None, throttle: bool = True) -> str:
+        """Creates a Chat message with the async client, or with the sync client in a worker thread."""
+        if CHAT_ASYNC_CLIENT == 1:
+            return await async_create_message(message=message, space_name=space_name or self.space_name, throttle=throttle)
+        return await asyncio.to_thread(create_message, message=message, space_name=space_name or self.space_name, throttle=throttle)
+
+    async def update_chat_message(self, name: str, message, throttle: bool = True):
+        """Updates a Chat message with the async client, or with the sync client in a worker thread."""
+        if CHAT_ASYNC_CLIENT == 1:
+            return await async_update_message(name=name, message=message, throttle=throttle)
+        return await asyncio.to_thread(update_message, name=name, message=message, throttle=throttle)
+
     def build_message(self, author, text, cards_v2, success: bool, failure: bool) -> dict:
         """Builds a Chat message for the given author, text, and cards_v2."""
         if text:
@@ -180,3 +268,10 @@ class AgentChat(IAiAgentHandler):
     def wrap_widgets_in_cards_v2(self, widgets=[]) -> list:
         """Wraps the given widgets in Chat cards_v2 structure."""
         return [{ "card": { "sections": [{ "widgets": widgets }]}}]
+
+def merge_chat_messages(messages: list) -> dict:
+    """Merges Chat messages sent in a row into one agent input, texts are joined and attachments kept in order."""
+    return {
+        "text": "\n\n".join(message.get("text") for message in messages if message.get("text")),
+        "attachment": [attachment for message in messages for attachment in message.get("attachment", [])]
+    }
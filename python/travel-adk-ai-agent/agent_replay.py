@@ -0,0 +1,91 @@
+# Copyright 2025 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Service that records and replays agent event streams."""
+
+import asyncio
+import glob
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+class AgentEventRecorder:
+    """Writes the raw events of one agent turn to a JSONL file, with their offset from the turn start."""
+
+    def __init__(self, directory: str, user_id: str):
+        os.makedirs(directory, exist_ok=True)
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        self.path = os.path.join(directory, f"{timestamp}-{user_id}-{uuid.uuid4().hex[:8]}.jsonl")
+        self._file = None
+        self._start = time.monotonic()
+
+    def record(self, event_raw):
+        """Appends the given raw event to the turn file."""
+        if self._file is None:
+            print(f"Recording agent events to {self.path}...")
+            self._file = open(self.path, "w", encoding="utf-8")
+        self._file.write(json.dumps({ "offset": time.monotonic() - self._start, "event": dict(event_raw) }) + "\n")
+
+    def close(self):
+        """Closes the turn file if any event was recorded."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def load_recording(path: str) -> list:
+    """Loads the (offset, event) pairs of a recorded turn."""
+    with open(path, encoding="utf-8") as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    return [(record["offset"], record["event"]) for record in records]
+
+class ReplayAgentEngine:
+    """Fake reasoning engine that replays recorded turns in a round-robin fashion.
+
+    The time scale applies to the recorded delays between events: 1 keeps the original timing,
+    values below 1 compress it and 0 replays the events as fast as possible.
+    """
+
+    def __init__(self, directory: str, time_scale: float = 1.0):
+        paths = sorted(glob.glob(os.path.join(directory, "*.jsonl")))
+        if len(paths) == 0:
+            raise ValueError(f"No recorded agent turns found in {directory}")
+        self.recordings = [load_recording(path) for path in paths]
+        self.time_scale = time_scale
+        self._next_recording = itertools.cycle(self.recordings)
+        self._lock = threading.Lock()
+
+    def get_next_recording(self) -> list:
+        """Returns the next recorded turn to replay."""
+        with self._lock:
+            return next(self._next_recording)
+
+    def stream_query(self, **kwargs):
+        """Replays the events of the next recorded turn."""
+        previous_offset = 0.0
+        for offset, event in self.get_next_recording():
+            time.sleep(max(0.0, offset - previous_offset) * self.time_scale)
+            previous_offset = offset
+            yield event
+
+    async def async_stream_query(self, **kwargs):
+        """Replays the events of the next recorded turn without blocking the event loop."""
+        previous_offset = 0.0
+        for offset, event in self.get_next_recording():
+            await asyncio.sleep(max(0.0, offset - previous_offset) * self.time_scale)
+            previous_offset = offset
+            yield event
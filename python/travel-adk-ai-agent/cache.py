@@ -0,0 +1,388 @@
+# Copyright 2025 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Service that handles in-memory and on-disk caching."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import metrics
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+class TtlLruCache:
+    """Thread-safe in-memory cache with per-entry time-to-live and LRU eviction."""
+
+    def __init__(self, name: str, max_size: int, ttl_seconds: float):
+        self.name = name
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Any:
+        """Returns the cached value for the key, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            # Mark as most recently used
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Stores the value for the key, evicting the least recently used entries if needed."""
+        if self.max_size <= 0 or self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Removes the entry for the key if any."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes all entries."""
+        with self._lock:
+            self._entries.clear()
+
+class DiskLruCache:
+    """Thread-safe on-disk cache of text values with a total size budget, per-entry time-to-live and LRU eviction.
+
+    Concurrent computations of the same missing value are deduplicated, hits, misses and deduplicated
+    computations are counted in the metrics prefixed by the cache name.
+    """
+
+    def __init__(self, name: str, directory: str, max_bytes: int, ttl_seconds: float):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        # File name -> (size, expiration timestamp), from least to most recently used
+        self._entries = OrderedDict()
+        self._size = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        if self.is_enabled():
+            os.makedirs(directory, exist_ok=True)
+            self._load_index()
+
+    def is_enabled(self) -> bool:
+        """Returns whether the cache stores values."""
+        return self.max_bytes > 0 and self.ttl_seconds > 0
+
+    def get_or_compute(self, key: str, compute: Callable[[], str]) -> str:
+        """Returns the cached value for the key, or computes and stores it once for all concurrent callers."""
+        if not self.is_enabled():
+            return compute()
+        file_name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        value = self._read(file_name)
+        if value is not None:
+            metrics.increment(f"{self.name}.hits")
+            return value
+        with self._lock:
+            future = self._inflight.get(file_name)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._inflight[file_name] = future
+        if not is_owner:
+            # Another caller is already computing the value
+            metrics.increment(f"{self.name}.deduplicated")
+            return future.result()
+        metrics.increment(f"{self.name}.misses")
+        try:
+            value = compute()
+            self._write(file_name, value)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[file_name]
+
+    def _load_index(self):
+        """Indexes the files left by previous instances, oldest first."""
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if entry.name.endswith(".tmp"):
+                # Leftover of an interrupted write, recent ones can belong to another process
+                if stat.st_mtime + self.ttl_seconds <= time.time():
+                    os.remove(entry.path)
+            else:
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        with self._lock:
+            for modified_at, file_name, size in sorted(files):
+                self._entries[file_name] = (size, modified_at + self.ttl_seconds)
+                self._size += size
+            self._evict()
+
+    def _read(self, file_name: str) -> str:
+        """Returns the stored value, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(file_name)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                self._remove(file_name)
+                return None
+            self._entries.move_to_end(file_name)
+        try:
+            with open(os.path.join(self.directory, file_name), encoding="ascii") as file:
+                return file.read()
+        except FileNotFoundError:
+            # Removed by another process sharing the directory
+            with self._lock:
+                if file_name in self._entries:
+                    self._size -= self._entries.pop(file_name)[0]
+            return None
+
+    def _write(self, file_name: str, value: str):
+        """Stores the value atomically and evicts the least recently used values above the size budget."""
+        if len(value) > self.max_bytes:
+            return
+        path = os.path.join(self.directory, file_name)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "w", encoding="ascii") as file:
+            file.write(value)
+        os.replace(temporary_path, path)
+        with self._lock:
+            if file_name in self._entries:
+                self._size -= self._entries.pop(file_name)[0]
+            self._entries[file_name] = (len(value), time.time() + self.ttl_seconds)
+            self._size += len(value)
+            self._evict()
+
+    def _evict(self):
+        """Removes expired values, then the least recently used ones until the size budget is met, lock must be held."""
+        now = time.time()
+        for file_name in [file_name for file_name, (_, expires_at) in self._entries.items() if expires_at <= now]:
+            self._remove(file_name)
+        while self._size > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, file_name: str):
+        """Removes the value from the index and the disk, lock must be held."""
+        size, _ = self._entries.pop(file_name)
+        self._size -= size
+        try:
+            os.remove(os.path.join(self.directory, file_name))
+        except FileNotFoundError:
+            pass
+
+class StaleWhileRevalidateCache:
+    """Thread-safe in-memory cache of API resources within a memory budget.
+
+    Fresh entries are served directly, stale ones are served immediately and refreshed in the background.
+    """
+
+    def __init__(self, name: str, fresh_seconds: float, stale_seconds: float, max_bytes: int):
+        self.name = name
+        self.fresh_seconds = fresh_seconds
+        self.stale_seconds = stale_seconds
+        self.max_bytes = max_bytes
+        # Key -> (value, size, fetched at), from least to most recently used
+        self._entries = OrderedDict()
+        self._size = 0
+        self._revalidating = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix=name)
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], Any]) -> Any:
+        """Returns the cached value for the key, fetching it if missing or too old."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            value, _, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            if age <= self.fresh_seconds:
+                metrics.increment(f"{self.name}.hits")
+                return value
+            if age <= self.fresh_seconds + self.stale_seconds:
+                metrics.increment(f"{self.name}.stale_hits")
+                self._schedule_revalidation(key, fetch)
+                return value
+        metrics.increment(f"{self.name}.misses")
+        value = fetch()
+        self._store(key, value)
+        return value
+
+    def delete(self, key: str):
+        """Removes the entry for the key if any."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry[1]
+
+    def _schedule_revalidation(self, key: str, fetch: Callable[[], Any]):
+        """Fetches the value again in the background, unless it's already being done."""
+        with self._lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+        self._executor.submit(self._revalidate, key, fetch)
+
+    def _revalidate(self, key: str, fetch: Callable[[], Any]):
+        """Fetches and stores the value, the stale value is kept on failures."""
+        try:
+            self._store(key, fetch())
+        except Exception as e:
+            print(f"Error occurred while revalidating {self.name} entry: {e}")
+        finally:
+            with self._lock:
+                self._revalidating.discard(key)
+
+    def _store(self, key: str, value):
+        """Stores the value and evicts the least recently used entries above the memory budget."""
+        # The serialized size is a good enough estimation of the memory used
+        size = len(json.dumps(value))
+        with self._lock:
+            previous_entry = self._entries.pop(key, None)
+            if previous_entry is not None:
+                self._size -= previous_entry[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size, time.monotonic())
+            self._size += size
+            while self._size > self.max_bytes:
+                self._size -= self._entries.popitem(last=False)[1][1]
+
+class IKeyValueStore(ABC):
+    """Interface key-value stores with per-entry time-to-live need to implement, values must be JSON serializable."""
+
+    @abstractmethod
+    def get(self, key: str) -> Any:
+        """Returns the value for the key, or None if missing or expired."""
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value, ttl_seconds: float):
+        """Stores the value for the key for the given time."""
+        pass
+
+    @abstractmethod
+    def add(self, key: str, value, ttl_seconds: float) -> bool:
+        """Atomically stores the value for the key only if it's missing or expired, returns whether it was stored."""
+        pass
+
+    @abstractmethod
+    def delete(self, key: str):
+        """Removes the value for the key if any."""
+        pass
+
+class MemoryKeyValueStore(IKeyValueStore):
+    """Key-value store kept in the process memory, it's lost on restarts."""
+
+    def __init__(self, max_size: int):
+        self._entries = TtlLruCache(name="memory_store", max_size=max_size, ttl_seconds=float("inf"))
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.time():
+            self._entries.delete(key)
+            return None
+        return value
+
+    def set(self, key: str, value, ttl_seconds: float):
+        self._entries.set(key, (value, time.time() + ttl_seconds))
+
+    def add(self, key: str, value, ttl_seconds: float) -> bool:
+        with self._lock:
+            if self.get(key) is not None:
+                return False
+            self.set(key, value, ttl_seconds)
+            return True
+
+    def delete(self, key: str):
+        self._entries.delete(key)
+
+def open_sqlite_database(path: str) -> sqlite3.Connection:
+    """Opens a SQLite file in autocommit mode, shared by the threads of the caller and the processes of an instance."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+    # Write-ahead logging lets several processes read while one writes
+    connection.execute("PRAGMA journal_mode=WAL")
+    return connection
+
+class SqliteKeyValueStore(IKeyValueStore):
+    """Key-value store kept in a local SQLite file, it survives restarts and is shared by the processes of an instance."""
+
+    def __init__(self, path: str, table: str):
+        self.table = table
+        self._connection = open_sqlite_database(path)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._connection.execute(f"DELETE FROM {table} WHERE expires_at <= ?", (time.time(),))
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            row = self._connection.execute(f"SELECT value FROM {self.table} WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value, ttl_seconds: float):
+        with self._lock:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + ttl_seconds)
+            )
+
+    def add(self, key: str, value, ttl_seconds: float) -> bool:
+        now = time.time()
+        with self._lock:
+            # Expired entries are replaced, the row count tells whether anything was written
+            cursor = self._connection.execute(
+                f"INSERT INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?) "
+                f"ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at WHERE {self.table}.expires_at <= ?",
+                (key, json.dumps(value), now + ttl_seconds, now)
+            )
+            return cursor.rowcount == 1
+
+    def delete(self, key: str):
+        with self._lock:
+            self._connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+def create_key_value_store(kind: str, table: str, sqlite_path: str, max_size: int) -> IKeyValueStore:
+    """Creates a key-value store of the given kind, either memory or sqlite."""
+    if kind == "sqlite":
+        return SqliteKeyValueStore(path=sqlite_path, table=table)
+    if kind == "memory":
+        return MemoryKeyValueStore(max_size=max_size)
+    raise ValueError(f"Unknown key-value store: {kind}")
@@ -22,10 +22,120 @@ LOCATION = os.environ.get('LOCATION', 'your-location')
 ENGINE_ID = os.environ.get('ENGINE_ID', 'your-engine-id')
 MAX_AI_AGENT_RETRIES = int(os.environ.get('MAX_AI_AGENT_RETRIES', '10'))
 
+# Agent request retry policy, delays are exponential with jitter and bounded by the host app timeout
+AI_AGENT_RETRY_BASE_DELAY_SECONDS = float(os.environ.get('AI_AGENT_RETRY_BASE_DELAY_SECONDS', '0.5'))
+AI_AGENT_RETRY_MAX_DELAY_SECONDS = float(os.environ.get('AI_AGENT_RETRY_MAX_DELAY_SECONDS', '4'))
+AI_AGENT_DEADLINE_MARGIN_SECONDS = float(os.environ.get('AI_AGENT_DEADLINE_MARGIN_SECONDS', '2'))
+# Attempts are not started with less time than this left before the deadline
+AI_AGENT_MIN_ATTEMPT_SECONDS = float(os.environ.get('AI_AGENT_MIN_ATTEMPT_SECONDS', '2'))
+CHAT_APP_TIMEOUT_SECONDS = float(os.environ.get('CHAT_APP_TIMEOUT_SECONDS', '30'))
+ADDON_TIMEOUT_SECONDS = float(os.environ.get('ADDON_TIMEOUT_SECONDS', '30'))
+
+# Reasoning engine handle reuse, set AGENT_ENGINE_WARM_UP to 1 to load Vertex AI and fetch it in the background when a worker starts
+AGENT_ENGINE_MAX_AGE_SECONDS = int(os.environ.get('AGENT_ENGINE_MAX_AGE_SECONDS', '3600'))
+AGENT_ENGINE_WARM_UP = int(os.environ.get('AGENT_ENGINE_WARM_UP', '0'))
+
+# Agent streaming, number of events read ahead and of concurrent handler calls
+AGENT_EVENT_QUEUE_SIZE = int(os.environ.get('AGENT_EVENT_QUEUE_SIZE', '16'))
+AGENT_HANDLER_CONCURRENCY = int(os.environ.get('AGENT_HANDLER_CONCURRENCY', '8'))
+# Threads reading synchronous agent streams, turns beyond it wait for a reader
+AGENT_STREAM_READER_THREADS = int(os.environ.get('AGENT_STREAM_READER_THREADS', '32'))
+
+# Agent event recording and replay, directories are disabled when empty
+AGENT_RECORD_DIR = os.environ.get('AGENT_RECORD_DIR', '')
+AGENT_REPLAY_DIR = os.environ.get('AGENT_REPLAY_DIR', '')
+AGENT_REPLAY_TIME_SCALE = float(os.environ.get('AGENT_REPLAY_TIME_SCALE', '1'))
+
+# Chat messages are acknowledged right away and answered in the background when CHAT_ASYNC_EXECUTION is 1
+# Note: The function must keep its CPU allocated after responding, e.g. with the --no-cpu-throttling flag
+CHAT_ASYNC_EXECUTION = int(os.environ.get('CHAT_ASYNC_EXECUTION', '0'))
+CHAT_BACKGROUND_TIMEOUT_SECONDS = float(os.environ.get('CHAT_BACKGROUND_TIMEOUT_SECONDS', '300'))
+# Background turn queue, the backend is either sqlite (survives restarts) or memory
+TURN_QUEUE_BACKEND = os.environ.get('TURN_QUEUE_BACKEND', 'sqlite')
+TURN_QUEUE_CONCURRENCY = int(os.environ.get('TURN_QUEUE_CONCURRENCY', '8'))
+TURN_QUEUE_LEASE_SECONDS = float(os.environ.get('TURN_QUEUE_LEASE_SECONDS', '60'))
+# Jobs whose lease expired are delivered again, e.g. after a worker crash, up to the maximum of attempts
+TURN_QUEUE_MAX_ATTEMPTS = int(os.environ.get('TURN_QUEUE_MAX_ATTEMPTS', '3'))
+TURN_QUEUE_POLL_SECONDS = float(os.environ.get('TURN_QUEUE_POLL_SECONDS', '1'))
+# Concurrent Chat turns of the same user are either queued, superseded by the newest one, or merged into the next turn
+# Note: With the sqlite turn queue, turns of a user are already completed one at a time so they're always queued
+TURN_SCHEDULER_POLICY = os.environ.get('TURN_SCHEDULER_POLICY', 'queue')
+
+# Duplicate Chat event deliveries are suppressed within the window, the store is either sqlite or memory
+IDEMPOTENCY_STORE = os.environ.get('IDEMPOTENCY_STORE', 'sqlite')
+IDEMPOTENCY_WINDOW_SECONDS = float(os.environ.get('IDEMPOTENCY_WINDOW_SECONDS', '600'))
+IDEMPOTENCY_MAX_SIZE = int(os.environ.get('IDEMPOTENCY_MAX_SIZE', '10000'))
+
+# Time given to running requests to complete when a worker process stops
+EVENT_LOOP_SHUTDOWN_TIMEOUT_SECONDS = float(os.environ.get('EVENT_LOOP_SHUTDOWN_TIMEOUT_SECONDS', '10'))
+
+# Chat message writes, set CHAT_ASYNC_CLIENT to 0 to use the synchronous client in worker threads
+CHAT_ASYNC_CLIENT = int(os.environ.get('CHAT_ASYNC_CLIENT', '1'))
+# Window during which successive writes of the same Chat message are merged, 0 to send them right away
+CHAT_WRITE_COALESCING_WINDOW_SECONDS = float(os.environ.get('CHAT_WRITE_COALESCING_WINDOW_SECONDS', '0.3'))
+# Chat message writes per space, Chat allows about 1 write per second in a space, 0 to disable the rate limiting
+# It's disabled by default with CHAT_ASYNC_EXECUTION set to 0, as throttled writes would lengthen Chat turns that must
+# answer within CHAT_APP_TIMEOUT_SECONDS, and the agent retry policy doesn't account for them
+CHAT_WRITE_RATE_PER_SECOND = float(os.environ.get('CHAT_WRITE_RATE_PER_SECOND', '1.0' if CHAT_ASYNC_EXECUTION == 1 else '0'))
+CHAT_WRITE_BURST = int(os.environ.get('CHAT_WRITE_BURST', '5'))
+CHAT_WRITE_RATE_LIMITER_MAX_SPACES = int(os.environ.get('CHAT_WRITE_RATE_LIMITER_MAX_SPACES', '10000'))
+
+# HTTP connection pools shared by all Google API clients, pool size is the maximum of connections per host
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', '10'))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '20'))
+HTTP_TIMEOUT_SECONDS = float(os.environ.get('HTTP_TIMEOUT_SECONDS', '60'))
+# Timeout of the checks of agent provided image URLs, images that don't answer in time are replaced by the default one
+IMAGE_URL_CHECK_TIMEOUT_SECONDS = float(os.environ.get('IMAGE_URL_CHECK_TIMEOUT_SECONDS', '3'))
+# Interval of the pings keeping gRPC connections alive
+GRPC_KEEPALIVE_TIME_SECONDS = float(os.environ.get('GRPC_KEEPALIVE_TIME_SECONDS', '30'))
+
+# Chat attachment downloads, larger attachments are rejected
+ATTACHMENT_MAX_BYTES = int(os.environ.get('ATTACHMENT_MAX_BYTES', str(20 * 1024 * 1024)))
+ATTACHMENT_DOWNLOAD_CHUNK_SIZE = int(os.environ.get('ATTACHMENT_DOWNLOAD_CHUNK_SIZE', str(1024 * 1024)))
+ATTACHMENT_DOWNLOAD_CONCURRENCY = int(os.environ.get('ATTACHMENT_DOWNLOAD_CONCURRENCY', '4'))
+
+# On-disk cache of encoded attachments, set ATTACHMENT_CACHE_MAX_BYTES to 0 to disable
+# Note: /tmp is an in-memory file system in Cloud Functions, the budget counts against the instance memory
+ATTACHMENT_CACHE_DIR = os.environ.get('ATTACHMENT_CACHE_DIR', '/tmp/attachment-cache')
+ATTACHMENT_CACHE_MAX_BYTES = int(os.environ.get('ATTACHMENT_CACHE_MAX_BYTES', str(100 * 1024 * 1024)))
+ATTACHMENT_CACHE_TTL_SECONDS = int(os.environ.get('ATTACHMENT_CACHE_TTL_SECONDS', '3600'))
+
+# Local SQLite file used by persistent stores, point it to a mounted volume to survive new instances
+CACHE_SQLITE_PATH = os.environ.get('CACHE_SQLITE_PATH', '/tmp/travel-agent-cache.sqlite3')
+
+# User to Chat app DM space cache, the store is either sqlite or memory
+CHAT_APP_DM_CACHE_STORE = os.environ.get('CHAT_APP_DM_CACHE_STORE', 'sqlite')
+CHAT_APP_DM_CACHE_MAX_SIZE = int(os.environ.get('CHAT_APP_DM_CACHE_MAX_SIZE', '10000'))
+CHAT_APP_DM_CACHE_TTL_SECONDS = int(os.environ.get('CHAT_APP_DM_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+
+# Maximum length of email bodies added to agent requests, roughly 4 characters per token
+EMAIL_BODY_MAX_CHARS = int(os.environ.get('EMAIL_BODY_MAX_CHARS', '8000'))
+# Raw HTML bytes decoded per body character when emails have no plain text part
+EMAIL_HTML_BYTES_PER_CHAR = int(os.environ.get('EMAIL_HTML_BYTES_PER_CHAR', '8'))
+
+# Parsed email contents cache, set EMAIL_CACHE_MAX_SIZE to 0 to disable
+EMAIL_CACHE_MAX_SIZE = int(os.environ.get('EMAIL_CACHE_MAX_SIZE', '100'))
+EMAIL_CACHE_TTL_SECONDS = int(os.environ.get('EMAIL_CACHE_TTL_SECONDS', '300'))
+
+# People API profile cache, stale profiles are served while being refreshed, set PROFILE_CACHE_MAX_BYTES to 0 to disable
+PROFILE_CACHE_FRESH_SECONDS = int(os.environ.get('PROFILE_CACHE_FRESH_SECONDS', '600'))
+PROFILE_CACHE_STALE_SECONDS = int(os.environ.get('PROFILE_CACHE_STALE_SECONDS', str(24 * 3600)))
+PROFILE_CACHE_MAX_BYTES = int(os.environ.get('PROFILE_CACHE_MAX_BYTES', str(10 * 1024 * 1024)))
+
+# Agent session ID cache, set SESSION_CACHE_MAX_SIZE to 0 to disable
+SESSION_CACHE_MAX_SIZE = int(os.environ.get('SESSION_CACHE_MAX_SIZE', '1000'))
+SESSION_CACHE_TTL_SECONDS = int(os.environ.get('SESSION_CACHE_TTL_SECONDS', '3600'))
+
 BASE_URL = os.environ.get('BASE_URL', 'your-google-cloud-function-url')
 
 RESET_SESSION_COMMAND_ID = int(os.environ.get('RESET_SESSION_COMMAND_ID','1'))
 
+# Maximum time to wait for each host context (e.g. profile, email) when rendering add-on cards
+HOST_CONTEXT_TIMEOUT_SECONDS = float(os.environ.get('HOST_CONTEXT_TIMEOUT_SECONDS', '3'))
+
+# Runtime metrics are logged by each worker at this interval and when it stops, 0 to disable the reports
+METRICS_REPORT_INTERVAL_SECONDS = float(os.environ.get('METRICS_REPORT_INTERVAL_SECONDS', '300'))
+
 NA_IMAGE_URL = os.environ.get('NA_IMAGE_URL', 'https://upload.wikimedia.org/wikipedia/commons/d/d1/Image_not_available.png?20210219185637')
 
 DEBUG = int(os.environ.get('DEBUG', '0'))
@@ -0,0 +1,133 @@
+# Copyright 2025 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Service that handles the event loop shared by all requests of a worker process."""
+
+import asyncio
+import atexit
+import concurrent.futures
+import contextvars
+import os
+import threading
+import metrics
+from typing import Any, Coroutine
+from env import EVENT_LOOP_SHUTDOWN_TIMEOUT_SECONDS
+
+class BackgroundEventLoop:
+    """Long-lived event loop running in a daemon thread, request threads submit coroutines to it.
+
+    Async clients (e.g. gRPC channels) created by the coroutines stay bound to this loop and are reused across requests.
+    The loop is started on first use and again in forked worker processes, as threads don't survive forks.
+    """
+
+    def __init__(self, name: str, shutdown_timeout_seconds: float):
+        self.name = name
+        self.shutdown_timeout_seconds = shutdown_timeout_seconds
+        self._loop = None
+        self._thread = None
+        self._pid = None
+        self._daemon_tasks = set()
+        self._lock = threading.Lock()
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        """Returns the running loop of the current process, starting it if needed."""
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, args=(self._loop,), name=self.name, daemon=True)
+                self._thread.start()
+                print(f"Started event loop {self.name} in worker {self._pid}")
+            return self._loop
+
+    def _run(self, loop: asyncio.AbstractEventLoop):
+        """Runs the loop until it's stopped, in the loop thread."""
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    def submit(self, coroutine: Coroutine, daemon: bool = False) -> concurrent.futures.Future:
+        """Schedules the coroutine on the loop and returns a future for its result.
+
+        The coroutine runs in a copy of the caller context, e.g. it can use the Flask request of the calling thread.
+        Daemon coroutines (e.g. dispatchers running forever) are cancelled right away on shutdown instead of being waited for.
+        """
+        loop = self.get_loop()
+        context = contextvars.copy_context()
+        future = concurrent.futures.Future()
+
+        def on_done(task: asyncio.Task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        def start():
+            if not future.set_running_or_notify_cancel():
+                coroutine.close()
+                return
+            task = loop.create_task(coroutine, context=context)
+            task.add_done_callback(on_done)
+            if daemon:
+                self._daemon_tasks.add(task)
+                task.add_done_callback(self._daemon_tasks.discard)
+
+        loop.call_soon_threadsafe(start)
+        return future
+
+    def run_coroutine(self, coroutine: Coroutine) -> Any:
+        """Runs the coroutine on the loop and waits for its result in the calling thread."""
+        metrics.increment("event_loop.requests")
+        return self.submit(coroutine).result()
+
+    def shutdown(self):
+        """Waits for running tasks within the shutdown timeout, cancels the remaining ones and stops the loop."""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            if loop is None or self._pid != os.getpid():
+                return
+            self._loop = None
+
+        async def drain():
+            for task in list(self._daemon_tasks):
+                task.cancel()
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            if tasks:
+                _, pending = await asyncio.wait(tasks, timeout=self.shutdown_timeout_seconds)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+            await loop.shutdown_asyncgens()
+
+        try:
+            asyncio.run_coroutine_threadsafe(drain(), loop).result(self.shutdown_timeout_seconds + 1)
+        except Exception as e:
+            print(f"Error occurred while draining event loop {self.name}: {repr(e)}")
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(self.shutdown_timeout_seconds)
+        print(f"Stopped event loop {self.name} in worker {self._pid} after {metrics.get_counter('event_loop.requests')} requests")
+
+# Event loop instance singleton, stopped when the worker process exits
+# Note: Thread pools are already shut down at that point, so drained tasks fail when they need a worker thread,
+# e.g. their background queue jobs are delivered again once their lease expires
+background_event_loop = BackgroundEventLoop("agent-event-loop", EVENT_LOOP_SHUTDOWN_TIMEOUT_SECONDS)
+atexit.register(background_event_loop.shutdown)
+
+def run_coroutine(coroutine: Coroutine) -> Any:
+    """Runs the coroutine on the event loop of the worker and waits for its result."""
+    return background_event_loop.run_coroutine(coroutine)
@@ -14,13 +14,48 @@
 
 """Service that handles Google Workspace operations."""
 
-import io
+import asyncio
+import functools
 import base64
+import time
+import metrics
+from contextvars import ContextVar
+from html.parser import HTMLParser
 from google.oauth2.service_account import Credentials
-from google.apps import chat_v1 as google_chat
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.http import MediaIoBaseDownload
+from google_auth_httplib2 import AuthorizedHttp
+from http_transport import httplib2_adapter, keepalive_grpc_transport
+from rate_limiter import KeyedRateLimiter
 from env import is_in_debug_mode
+from env import ATTACHMENT_MAX_BYTES, ATTACHMENT_DOWNLOAD_CHUNK_SIZE, ATTACHMENT_CACHE_DIR, ATTACHMENT_CACHE_MAX_BYTES, ATTACHMENT_CACHE_TTL_SECONDS
+from env import CHAT_WRITE_RATE_PER_SECOND, CHAT_WRITE_BURST, CHAT_WRITE_RATE_LIMITER_MAX_SPACES
+from env import CACHE_SQLITE_PATH, CHAT_APP_DM_CACHE_STORE, CHAT_APP_DM_CACHE_MAX_SIZE, CHAT_APP_DM_CACHE_TTL_SECONDS
+from env import EMAIL_BODY_MAX_CHARS, EMAIL_HTML_BYTES_PER_CHAR, EMAIL_CACHE_MAX_SIZE, EMAIL_CACHE_TTL_SECONDS, PROFILE_CACHE_FRESH_SECONDS, PROFILE_CACHE_STALE_SECONDS, PROFILE_CACHE_MAX_BYTES
+from cache import DiskLruCache, StaleWhileRevalidateCache, TtlLruCache, create_key_value_store
+
+# ------- Google API discovery services
+
+@functools.cache
+def get_api_service(service_name: str, version: str):
+    """Builds an API service once per process from the discovery document bundled with the API client library.
+
+    The service is not bound to any credentials, callers execute its requests with their own authorized HTTP object.
+    """
+    return build_from_document(get_static_doc(service_name, version), http=httplib2_adapter)
+
+@functools.cache
+def get_api_resource(service_name: str, version: str, path: str):
+    """Returns the resource collection at the given dotted path of an API service (e.g. users.messages), built once per process."""
+    resource = get_api_service(service_name, version)
+    for name in path.split('.'):
+        resource = getattr(resource, name)()
+    return resource
+
+def authorize_http(credentials) -> AuthorizedHttp:
+    """Creates an HTTP object that authorizes requests with the given credentials, connections are shared."""
+    return AuthorizedHttp(credentials, http=httplib2_adapter)
 
 # ------- Google Chat API
 
@@ -36,115 +71,493 @@ SERVICE_ACCOUNT_FILE = 'credentials.json'
 # All Chat operations are taken by the Chat app itself
 CHAT_APP_AUTH_OAUTH_SCOPE = ["https://www.googleapis.com/auth/chat.bot"]
 
-# The Chat DM space associated with the user
-SPACE_NAME = None
+# The Chat DM space associated with the user of the current request, it's isolated
+# per thread and per asyncio task so that concurrent requests don't share it
+CHAT_SPACE_NAME: ContextVar[str] = ContextVar("chat_space_name", default=None)
 
 def set_chat_config(spaceName: str):
-    """Sets the Chat space name for subsequent operations."""
-    global SPACE_NAME
-    SPACE_NAME = spaceName
-    print(f"Space is set to {SPACE_NAME}")
+    """Sets the Chat space name for subsequent operations of the current request."""
+    CHAT_SPACE_NAME.set(spaceName)
+    print(f"Space is set to {spaceName}")
+
+def get_chat_space_name() -> str:
+    """Returns the Chat space name of the current request."""
+    return CHAT_SPACE_NAME.get()
+
+@functools.cache
+def load_service_account_credentials() -> Credentials:
+    """Loads the service account credentials once per process."""
+    return Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
+
+@functools.cache
+def get_google_chat():
+    """Returns the Google Chat client library module, imported on first use to keep cold starts short."""
+    from google.apps import chat_v1
+    return chat_v1
 
 def create_google_chat_cloud_client():
     """Creates a Google Chat Cloud client using the service account."""
-    creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
+    google_chat = get_google_chat()
     return google_chat.ChatServiceClient(
-        credentials=creds,
-        client_options={ "scopes": CHAT_APP_AUTH_OAUTH_SCOPE }
+        credentials=load_service_account_credentials(),
+        client_options={ "scopes": CHAT_APP_AUTH_OAUTH_SCOPE },
+        transport=keepalive_grpc_transport(google_chat.services.chat_service.transports.ChatServiceGrpcTransport)
     )
 
-def create_google_chat_api_client():
-    """Creates a Google Chat API client using the service account."""
-    creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE).with_scopes(CHAT_APP_AUTH_OAUTH_SCOPE)
-    return build('chat', 'v1', credentials=creds)
+@functools.cache
+def get_google_chat_cloud_client():
+    """Returns the Google Chat Cloud client singleton, created on first use."""
+    return create_google_chat_cloud_client()
 
-# Client instance singletons
-google_chat_cloud_client = create_google_chat_cloud_client()
-google_chat_api_client = create_google_chat_api_client()
+# Async client instances per event loop, as their gRPC channels are bound to the loop they are created in
+# Note: Requests share the background event loop of the worker, so there is usually only one
+_google_chat_async_clients = {}
+
+def get_google_chat_async_client():
+    """Returns the async Google Chat Cloud client shared by all requests running in the current event loop."""
+    loop = asyncio.get_running_loop()
+    client = _google_chat_async_clients.get(loop)
+    if client is None:
+        # Drop the clients of event loops that are gone
+        for closed_loop in [l for l in list(_google_chat_async_clients) if l.is_closed()]:
+            _google_chat_async_clients.pop(closed_loop, None)
+        google_chat = get_google_chat()
+        client = google_chat.ChatServiceAsyncClient(
+            credentials=load_service_account_credentials(),
+            client_options={ "scopes": CHAT_APP_AUTH_OAUTH_SCOPE },
+            transport=keepalive_grpc_transport(google_chat.services.chat_service.transports.ChatServiceGrpcAsyncIOTransport)
+        )
+        _google_chat_async_clients[loop] = client
+    return client
+
+# User to Chat app DM space cache, the DM space of a user almost never changes
+chat_app_dm_store = create_key_value_store(
+    kind=CHAT_APP_DM_CACHE_STORE,
+    table="chat_app_dm",
+    sqlite_path=CACHE_SQLITE_PATH,
+    max_size=CHAT_APP_DM_CACHE_MAX_SIZE
+)
 
 def find_chat_app_dm(user_name: str) -> str:
-    """Finds the direct message space name between the Chat app and the given user."""
-    return google_chat_cloud_client.find_direct_message(google_chat.FindDirectMessageRequest(
-        name=user_name
-    )).name
+    """Finds the direct message space name between the Chat app and the given user, from the cache if possible."""
+    space_name = chat_app_dm_store.get(user_name)
+    if space_name is not None:
+        metrics.increment("chat_app_dm_cache.hits")
+    else:
+        metrics.increment("chat_app_dm_cache.misses")
+        space_name = get_google_chat_cloud_client().find_direct_message(get_google_chat().FindDirectMessageRequest(
+            name=user_name
+        )).name
+        remember_chat_app_dm(user_name, space_name)
+    metrics.set_gauge("chat_app_dm_cache.hit_ratio", metrics.get_ratio("chat_app_dm_cache.hits", "chat_app_dm_cache.misses"))
+    return space_name
+
+def remember_chat_app_dm(user_name: str, space_name: str):
+    """Caches the direct message space name between the Chat app and the given user."""
+    chat_app_dm_store.set(user_name, space_name, CHAT_APP_DM_CACHE_TTL_SECONDS)
+
+def invalidate_chat_app_dm(user_name: str):
+    """Removes the cached direct message space name between the Chat app and the given user, e.g. when the user removed the app."""
+    chat_app_dm_store.delete(user_name)
+
+class AttachmentTooLargeError(Exception):
+    """Raised when an attachment exceeds the maximum size allowed."""
+
+class Base64EncodingBuffer:
+    """Write-only file-like object that base64 encodes written bytes incrementally into a single buffer."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # Number of raw bytes written so far
+        self.size = 0
+        self._buffer = bytearray()
+        self._encoded_size = 0
+        # Raw bytes that can't be encoded until the next write, base64 works on 3-byte groups
+        self._remainder = b""
+
+    def reserve(self, total_size: int):
+        """Allocates the buffer for the encoded content once the total size is known."""
+        if total_size > self.max_bytes:
+            raise AttachmentTooLargeError(f"Attachment of {total_size} bytes exceeds the limit of {self.max_bytes} bytes")
+        self._ensure_capacity(4 * ((total_size + 2) // 3))
+
+    def write(self, data: bytes) -> int:
+        """Encodes the given bytes, keeping the trailing bytes that don't form a complete group."""
+        written_size = len(data)
+        self.size += written_size
+        if self.size > self.max_bytes:
+            raise AttachmentTooLargeError(f"Attachment exceeds the limit of {self.max_bytes} bytes")
+        data = self._remainder + data if self._remainder else data
+        encodable_size = len(data) - len(data) % 3
+        self._append(base64.b64encode(memoryview(data)[:encodable_size]))
+        self._remainder = bytes(data[encodable_size:])
+        return written_size
+
+    def getvalue(self) -> str:
+        """Returns the base64 encoded content written so far."""
+        if self._remainder:
+            self._append(base64.b64encode(self._remainder))
+            self._remainder = b""
+        return str(memoryview(self._buffer)[:self._encoded_size], 'ascii')
+
+    def _append(self, encoded: bytes):
+        """Copies encoded bytes at the end of the buffer, growing it only if it was not reserved."""
+        self._ensure_capacity(self._encoded_size + len(encoded))
+        self._buffer[self._encoded_size:self._encoded_size + len(encoded)] = encoded
+        self._encoded_size += len(encoded)
+
+    def _ensure_capacity(self, capacity: int):
+        """Grows the buffer to the given capacity, keeping the encoded content."""
+        if len(self._buffer) < capacity:
+            buffer = bytearray(max(capacity, 2 * len(self._buffer)))
+            buffer[:self._encoded_size] = memoryview(self._buffer)[:self._encoded_size]
+            self._buffer = buffer
+
+# Encoded attachments cache, retried turns and redelivered events don't download attachments again
+attachment_cache = DiskLruCache(
+    name="attachment_cache",
+    directory=ATTACHMENT_CACHE_DIR,
+    max_bytes=ATTACHMENT_CACHE_MAX_BYTES,
+    ttl_seconds=ATTACHMENT_CACHE_TTL_SECONDS
+)
 
 def download_chat_attachment(attachment_name) -> str:
-    """Downloads a Chat message attachment and returns its content as a base64 encoded string."""
-    request = google_chat_api_client.media().download_media(resourceName=attachment_name)
-    buffer = io.BytesIO()
-    downloader = MediaIoBaseDownload(buffer, request)
+    """Returns the content of a Chat message attachment as a base64 encoded string, from the cache if possible."""
+    return attachment_cache.get_or_compute(attachment_name, lambda: fetch_chat_attachment(attachment_name))
+
+def fetch_chat_attachment(attachment_name) -> str:
+    """Downloads a Chat message attachment by chunks and returns its content as a base64 encoded string."""
+    start = time.monotonic()
+    request = get_api_resource('chat', 'v1', 'media').download_media(resourceName=attachment_name)
+    # Each download uses its own authorized HTTP object so that they can run in parallel over the shared connections
+    request.http = authorize_http(load_service_account_credentials().with_scopes(CHAT_APP_AUTH_OAUTH_SCOPE))
+    buffer = Base64EncodingBuffer(max_bytes=ATTACHMENT_MAX_BYTES)
+    downloader = MediaIoBaseDownload(buffer, request, chunksize=ATTACHMENT_DOWNLOAD_CHUNK_SIZE)
     done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-        if is_in_debug_mode():
-            if status.total_size:
-                print(f'Total size: {status.total_size}')
-            print(f'Download {int(status.progress() * 100)}')
-    return base64.b64encode(buffer.getvalue()).decode('utf-8')
-
-def create_message(message) -> str:
-    """Creates a Chat message in the configured space."""
-    print(f"Creating message in space {SPACE_NAME}...")
-    return google_chat_cloud_client.create_message(google_chat.CreateMessageRequest(
-        parent=SPACE_NAME,
+    reserved = False
+    try:
+        while done is False:
+            downloaded_size = buffer.size
+            status, done = downloader.next_chunk()
+            metrics.increment("attachment.download_bytes", buffer.size - downloaded_size)
+            if status.total_size and not reserved:
+                # Fails early if the attachment is too large
+                buffer.reserve(status.total_size)
+                reserved = True
+            if is_in_debug_mode() and status.total_size:
+                print(f"Downloading attachment {attachment_name}: {int(status.progress() * 100)}% of {status.total_size} bytes")
+    except AttachmentTooLargeError:
+        metrics.increment("attachment.rejected_too_large")
+        raise
+    duration = time.monotonic() - start
+    metrics.increment("attachment.downloads")
+    metrics.record_timing("attachment.download", duration)
+    print(f"Downloaded attachment {attachment_name}: {buffer.size} bytes in {duration:.2f}s")
+    return buffer.getvalue()
+
+# Chat message writes per space, so that busy turns stay under the per-space write quota instead of failing on it
+chat_write_rate_limiter = KeyedRateLimiter(
+    name="chat_write_rate_limiter",
+    rate_per_second=CHAT_WRITE_RATE_PER_SECOND,
+    burst=CHAT_WRITE_BURST,
+    max_keys=CHAT_WRITE_RATE_LIMITER_MAX_SPACES
+)
+
+def get_message_space_name(name: str) -> str:
+    """Returns the space name of a Chat message from its resource name."""
+    return name.split("/messages/")[0]
+
+def create_message(message, space_name: str = None, throttle: bool = True) -> str:
+    """Creates a Chat message in the given space, defaults to the configured space.
+
+    The write waits for the space rate limiter unless the caller already did.
+    """
+    space_name = space_name or get_chat_space_name()
+    if throttle:
+        chat_write_rate_limiter.acquire(space_name)
+    print(f"Creating message in space {space_name}...")
+    return get_google_chat_cloud_client().create_message(get_google_chat().CreateMessageRequest(
+        parent=space_name,
         message=message
     )).name
 
-def update_message(name: str, message):
-    """Updates a Chat message in the configured space."""
-    print(f"Updating message in space {SPACE_NAME}...")
-    return google_chat_cloud_client.update_message(google_chat.UpdateMessageRequest(
+def update_message(name: str, message, throttle: bool = True):
+    """Updates a Chat message, the space is part of the message name."""
+    if throttle:
+        chat_write_rate_limiter.acquire(get_message_space_name(name))
+    print(f"Updating message {name}...")
+    return get_google_chat_cloud_client().update_message(get_google_chat().UpdateMessageRequest(
         message=message | { "name": name },
         update_mask="*"
     ))
     
+async def async_create_message(message, space_name: str = None, throttle: bool = True) -> str:
+    """Creates a Chat message in the given space without blocking the event loop, defaults to the configured space."""
+    space_name = space_name or get_chat_space_name()
+    if throttle:
+        await chat_write_rate_limiter.async_acquire(space_name)
+    print(f"Creating message in space {space_name}...")
+    return (await get_google_chat_async_client().create_message(get_google_chat().CreateMessageRequest(
+        parent=space_name,
+        message=message
+    ))).name
+
+async def async_update_message(name: str, message, throttle: bool = True):
+    """Updates a Chat message without blocking the event loop, the space is part of the message name."""
+    if throttle:
+        await chat_write_rate_limiter.async_acquire(get_message_space_name(name))
+    print(f"Updating message {name}...")
+    return await get_google_chat_async_client().update_message(get_google_chat().UpdateMessageRequest(
+        message=message | { "name": name },
+        update_mask="*"
+    ))
+
+class PendingChatMessage:
+    """State of a Chat message whose writes go through a coalescer."""
+
+    def __init__(self, message, space_name: str):
+        self.message = message
+        self.space_name = space_name
+        # The message resource name, set once the message is created
+        self.name = None
+        # Whether the latest state still needs to be sent
+        self.dirty = True
+        self.flush_task = None
+        self.flush_now = asyncio.Event()
+        self.lock = asyncio.Lock()
+
+class ChatWriteCoalescer:
+    """Delays Chat message writes for a short window so that only the latest state of a message is sent.
+
+    Creations are sent in the order they were requested. If a message is updated before its creation is
+    sent, the creation carries the latest state directly.
+    With a rate limiter, flushes wait for their token before reading the message state, so updates requested
+    while throttled are merged into the same write. The write functions are then called with throttle=False.
+    """
+
+    def __init__(self, window_seconds: float, create_function, update_function, rate_limiter: KeyedRateLimiter = None):
+        self.window_seconds = window_seconds
+        self.create_function = create_function
+        self.update_function = update_function
+        self.rate_limiter = rate_limiter
+        self._pending_messages = []
+        self._flush_tasks = []
+        self._last_create_task = None
+
+    async def create(self, message, space_name: str = None, coalesce: bool = True) -> PendingChatMessage:
+        """Requests the creation of a message, coalesce it with its upcoming updates unless disabled."""
+        pending = PendingChatMessage(message, space_name)
+        self._pending_messages.append(pending)
+        self._schedule_flush(pending, self.window_seconds if coalesce else 0)
+        self._last_create_task = pending.flush_task
+        return pending
+
+    async def update(self, pending: PendingChatMessage, message):
+        """Requests the update of a message, merging it with the other updates of the window."""
+        pending.message = message
+        pending.dirty = True
+        if pending.flush_task is None:
+            self._schedule_flush(pending, self.window_seconds)
+
+    async def flush(self):
+        """Sends all pending writes immediately and raises the first failure if any."""
+        for pending in self._pending_messages:
+            pending.flush_now.set()
+        results = await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+        self._flush_tasks = []
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise errors[0]
+
+    def _schedule_flush(self, pending: PendingChatMessage, delay_seconds: float):
+        """Schedules the sending of the latest state of the message after the given delay."""
+        previous_create_task = self._last_create_task if pending.name is None else None
+        pending.flush_task = asyncio.create_task(self._flush(pending, delay_seconds, previous_create_task))
+        self._flush_tasks.append(pending.flush_task)
+
+    async def _flush(self, pending: PendingChatMessage, delay_seconds: float, previous_create_task: asyncio.Task):
+        """Sends the latest state of the message once the delay is over or a flush is requested."""
+        if delay_seconds > 0 and not pending.flush_now.is_set():
+            try:
+                await asyncio.wait_for(pending.flush_now.wait(), delay_seconds)
+            except TimeoutError:
+                pass
+        write_options = {}
+        if self.rate_limiter:
+            space_name = get_message_space_name(pending.name) if pending.name else pending.space_name or get_chat_space_name()
+            await self.rate_limiter.async_acquire(space_name)
+            write_options["throttle"] = False
+        async with pending.lock:
+            # Updates requested from now on need another flush
+            pending.flush_task = None
+            if not pending.dirty:
+                return
+            pending.dirty = False
+            if pending.name is None:
+                if previous_create_task:
+                    # Only the order matters here, failures are reported by the previous flush
+                    await asyncio.wait([previous_create_task])
+                pending.name = await self.create_function(message=pending.message, space_name=pending.space_name, **write_options)
+            else:
+                await self.update_function(name=pending.name, message=pending.message, **write_options)
+
 # ------- Gmail API
 
-def get_email(credentials: Credentials, message_id: str, addon_event_access_token: str):
-    """Fetches a full email message by its ID using the given credentials and add-on event access token."""
-    # Create Gmail API client, no singleton as we need to pass user credentials
-    google_gmail_api_client = build('gmail', 'v1', credentials=credentials)
-    request = google_gmail_api_client.users().messages().get(
+# Fields needed to extract the subject and body, nested multipart emails deeper than this are not walked
+# Only the top-level headers are returned, the headers of the parts are skipped
+EMAIL_BODY_MAX_DEPTH = 5
+EMAIL_CONTENTS_FIELDS = (
+    "payload(headers(name,value),"
+    + "mimeType,body/data,parts(" * (EMAIL_BODY_MAX_DEPTH - 1)
+    + "mimeType,body/data" + ")" * EMAIL_BODY_MAX_DEPTH
+)
+
+# Parsed email contents, entries are per user and message and only live for the time the email is likely to stay opened
+email_contents_cache = TtlLruCache(name="email_contents", max_size=EMAIL_CACHE_MAX_SIZE, ttl_seconds=EMAIL_CACHE_TTL_SECONDS)
+
+def get_email(credentials: Credentials, message_id: str, addon_event_access_token: str, format: str = 'full', **kwargs):
+    """Fetches an email message by its ID using the given credentials and add-on event access token.
+
+    Extra arguments (e.g. fields, metadataHeaders) are passed to the Gmail API request.
+    """
+    # The shared Gmail API service is used with the user credentials
+    request = get_api_resource('gmail', 'v1', 'users.messages').get(
         id=message_id,
         userId='me',
-        format='full'
+        format=format,
+        **kwargs
     )
     request.headers["X-Goog-Gmail-Access-Token"] = addon_event_access_token
-    return request.execute()
+    return request.execute(http=authorize_http(credentials))
 
-def extract_email_contents(message):
-    """Extracts the subject and body text from a Gmail message object."""
+def get_email_contents(credentials: Credentials, user_name: str, message_id: str, addon_event_access_token: str) -> tuple:
+    """Returns the subject, body and truncation flag of an email, only the fields needed are fetched."""
+    cache_key = f"{user_name}/{message_id}"
+    contents = email_contents_cache.get(cache_key)
+    if contents is not None:
+        return contents
+    # A single request that skips file names, attachment metadata and the headers of the parts
+    message = get_email(
+        credentials=credentials,
+        message_id=message_id,
+        addon_event_access_token=addon_event_access_token,
+        fields=EMAIL_CONTENTS_FIELDS
+    )
+    contents = extract_email_contents(message)
+    email_contents_cache.set(cache_key, contents)
+    return contents
+
+class HtmlTextExtractor(HTMLParser):
+    """Extracts the visible text of an HTML document, script and style contents are skipped."""
+
+    SKIPPED_TAGS = {"script", "style", "head", "title"}
+    BLOCK_TAGS = {"br", "p", "div", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "hr"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self._skipped_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self._skipped_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS:
+            self._skipped_depth = max(0, self._skipped_depth - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append("\n")
+
+    def handle_data(self, data):
+        if self._skipped_depth == 0:
+            self.chunks.append(data)
+
+    def get_text(self) -> str:
+        """Returns the extracted text with collapsed whitespaces and blank lines."""
+        lines = (" ".join(line.split()) for line in "".join(self.chunks).splitlines())
+        return "\n".join(line for line in lines if line)
+
+def decode_base64_prefix(data: str, max_bytes: int) -> tuple:
+    """Decodes at most max_bytes from URL-safe base64 data, returns the bytes and whether all were decoded."""
+    # Every 4 base64 characters encode 3 bytes
+    max_chars = -(-max_bytes // 3) * 4
+    if len(data) <= max_chars:
+        return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)), True
+    return base64.urlsafe_b64decode(data[:max_chars])[:max_bytes], False
+
+def find_email_body_parts(payload) -> tuple:
+    """Walks the MIME tree iteratively in order, returns the first text/plain and text/html parts with data."""
+    html_part = None
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get('body', {}).get('data'):
+            if part.get('mimeType') == 'text/plain':
+                return part, html_part
+            if part.get('mimeType') == 'text/html' and html_part is None:
+                html_part = part
+        # Reversed so that parts are visited in document order
+        stack.extend(reversed(part.get('parts', [])))
+    return None, html_part
+
+def extract_email_contents(message, max_chars: int = EMAIL_BODY_MAX_CHARS) -> tuple:
+    """Extracts the subject and body text from a Gmail message object.
+
+    The body is the first plain text part, or the first HTML part stripped of its markup, limited to max_chars.
+    Returns the subject, the body and whether the body was truncated.
+    """
     payload = message['payload']
     # Subject
-    headers = payload['headers']
-    subject = next((header['value'] for header in headers if header['name'] == 'Subject'), '')    
+    headers = payload.get('headers', [])
+    subject = next((header['value'] for header in headers if header['name'] == 'Subject'), '')
     # Body
-    def get_body_data(part):
-        """Recursively looks for the plain text part in the message payload."""
-        if part['mimeType'] == 'text/plain':
-            data = part['body'].get('data')
-            if data:
-                return base64.urlsafe_b64decode(data).decode('utf-8')
-        if 'parts' in part:
-            for subpart in part['parts']:
-                body_text = get_body_data(subpart)
-                if body_text:
-                    return body_text
-        return None
-    body_text = get_body_data(payload)
-    return subject, body_text if body_text else ''
+    plain_part, html_part = find_email_body_parts(payload)
+    if plain_part is not None:
+        # UTF-8 characters are at most 4 bytes long, the decoded prefix is enough for the budget
+        data, complete = decode_base64_prefix(plain_part['body']['data'], max_chars * 4)
+        body = data.decode('utf-8', errors='ignore')
+    elif html_part is not None:
+        # Markup usually dominates HTML emails, a larger prefix is decoded before it's stripped
+        data, complete = decode_base64_prefix(html_part['body']['data'], max_chars * EMAIL_HTML_BYTES_PER_CHAR)
+        extractor = HtmlTextExtractor()
+        extractor.feed(data.decode('utf-8', errors='ignore'))
+        extractor.close()
+        body = extractor.get_text()
+    else:
+        return subject, '', False
+    truncated = not complete or len(body) > max_chars
+    return subject, body[:max_chars], truncated
 
 # ------- People API
 
 # The prefix used by the for the People resource name.
 PEOPLE_PREFIX = "people/"
 
-def get_person_profile(credentials: Credentials, people_name: str, person_fields: str):
+# Profile cache, entries are per person and requested fields
+profile_cache = StaleWhileRevalidateCache(
+    name="profile_cache",
+    fresh_seconds=PROFILE_CACHE_FRESH_SECONDS,
+    stale_seconds=PROFILE_CACHE_STALE_SECONDS,
+    max_bytes=PROFILE_CACHE_MAX_BYTES
+)
+
+def get_person_profile(credentials: Credentials, requester: str, people_name: str, person_fields: str):
+    """Returns a person's profile from the cache if possible, or fetches it using the given credentials.
+
+    Entries are per requester, the credentials owner, as the fields a profile returns depend on who reads it.
+    """
+    return profile_cache.get_or_fetch(
+        f"{requester}/{people_name}?personFields={person_fields}",
+        lambda: fetch_person_profile(credentials=credentials, people_name=people_name, person_fields=person_fields)
+    )
+
+def fetch_person_profile(credentials: Credentials, people_name: str, person_fields: str):
     """Fetches a person's profile using the given credentials."""
-    # Create People API client, no singleton as we need to pass user credentials
-    google_people_api_client = build('people', 'v1', credentials=credentials)
-    request = google_people_api_client.people().get(
+    # The shared People API service is used with the user credentials
+    request = get_api_resource('people', 'v1', 'people').get(
         resourceName=people_name,
         personFields=person_fields
     )
-    return request.execute()
+    return request.execute(http=authorize_http(credentials))
@@ -0,0 +1,129 @@
+# Copyright 2025 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Service that handles the host app contexts users can add to their messages."""
+
+import asyncio
+import json
+from abc import ABC, abstractmethod
+from typing import Any
+from google.oauth2.credentials import Credentials
+from google_workspace import get_email_contents, get_person_profile, USERS_PREFIX, PEOPLE_PREFIX
+from env import HOST_CONTEXT_TIMEOUT_SECONDS, is_in_debug_mode
+
+class IHostContextProvider(ABC):
+    """Interface host context providers need to implement."""
+
+    # Identifier used as the value of the context selection input
+    id: str
+    # Name displayed to the user
+    name: str
+
+    @abstractmethod
+    def is_available(self, event) -> bool:
+        """Returns whether the context can be fetched for the given add-on event, it must not call any API."""
+        pass
+
+    @abstractmethod
+    def fetch(self, event, user_name: str, credentials: Credentials) -> Any:
+        """Fetches the context value for the given add-on event."""
+        pass
+
+    @abstractmethod
+    def to_prompt(self, value) -> str:
+        """Formats the context value to be added to the agent request message."""
+        pass
+
+class ProfileContextProvider(IHostContextProvider):
+    """Context provider for the Google profile of the user."""
+
+    id = "profile"
+    name = "Google profile"
+
+    def is_available(self, event) -> bool:
+        return True
+
+    def fetch(self, event, user_name: str, credentials: Credentials) -> Any:
+        return get_person_profile(
+            credentials=credentials,
+            requester=user_name,
+            people_name=user_name.replace(USERS_PREFIX, PEOPLE_PREFIX),
+            person_fields="birthdays"
+        )
+
+    def to_prompt(self, value) -> str:
+        return f"\n\nPUBLIC PROFILE OF THE USER IN JSON FORMAT: {json.dumps(value)}"
+
+class EmailContextProvider(IHostContextProvider):
+    """Context provider for the email currently opened in Gmail."""
+
+    id = "email"
+    name = "Current email"
+
+    def is_available(self, event) -> bool:
+        return "messageId" in event.get("gmail", {})
+
+    def fetch(self, event, user_name: str, credentials: Credentials) -> Any:
+        return get_email_contents(
+            credentials=credentials,
+            user_name=user_name,
+            message_id=event["gmail"]["messageId"],
+            addon_event_access_token=event["gmail"]["accessToken"]
+        )
+
+    def to_prompt(self, value) -> str:
+        email_subject, email_body, truncated = value
+        if truncated:
+            email_body += "\n[The rest of the email was truncated]"
+        return f"\n\nEMAIL THE USER HAS OPENED ON SCREEN:\nSubject: {email_subject}\nBody:\n---\n{email_body}\n---"
+
+# Registered providers, in display order
+# Note; This could be expanded to calendar, drive, docs, sheets, slides
+host_context_providers = []
+
+def register_host_context_provider(provider: IHostContextProvider):
+    """Registers a host context provider."""
+    host_context_providers.append(provider)
+
+register_host_context_provider(ProfileContextProvider())
+register_host_context_provider(EmailContextProvider())
+
+def get_available_host_context_providers(event) -> list:
+    """Returns the providers whose context can be fetched for the given add-on event."""
+    return [provider for provider in host_context_providers if provider.is_available(event)]
+
+async def fetch_host_context(name: str, function, **kwargs):
+    """Fetches a host context in a worker thread, returns None if it fails or takes too long."""
+    try:
+        # The worker thread can't be interrupted, it's only not waited for after the timeout
+        return await asyncio.wait_for(asyncio.to_thread(function, **kwargs), HOST_CONTEXT_TIMEOUT_SECONDS)
+    except Exception as e:
+        print(f"Context {name} is unavailable: {repr(e)}")
+        return None
+
+async def build_selected_host_contexts_prompt(event, user_name: str, credentials: Credentials, selected_ids: list) -> str:
+    """Fetches the selected contexts in parallel and formats them for the agent request message, unavailable ones are skipped."""
+    providers = [provider for provider in get_available_host_context_providers(event) if provider.id in selected_ids]
+    values = await asyncio.gather(*[
+        fetch_host_context(provider.id, provider.fetch, event=event, user_name=user_name, credentials=credentials)
+        for provider in providers
+    ])
+    prompt = ""
+    for provider, value in zip(providers, values):
+        if value is None:
+            continue
+        if is_in_debug_mode():
+            print(f"Context {provider.id}: {value}")
+        prompt += provider.to_prompt(value)
+    return prompt
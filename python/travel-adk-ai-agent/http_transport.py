@@ -0,0 +1,152 @@
+# Copyright 2025 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Service that handles the HTTP connections shared by all Google API clients."""
+
+import functools
+import threading
+import urllib.parse
+import httplib2
+import requests
+import metrics
+from requests.adapters import HTTPAdapter
+from env import HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, HTTP_TIMEOUT_SECONDS, GRPC_KEEPALIVE_TIME_SECONDS
+
+# Requests to Google API hosts are tracked per host, the others (e.g. image URLs from agent answers) are tracked together
+GOOGLE_API_HOST_SUFFIX = ".googleapis.com"
+OTHER_HOSTS = "other"
+
+class PooledHttpTransport:
+    """Thread-safe HTTP transport that keeps connections alive in per-host pools.
+
+    Requests to a host wait for a free connection once its pool is full, so pool_maxsize is also the per-host limit.
+    """
+
+    def __init__(self, pool_connections: int, pool_maxsize: int, timeout_seconds: float):
+        self.timeout_seconds = timeout_seconds
+        self.pool_maxsize = pool_maxsize
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        # Tracked host -> (in-flight requests, peak in-flight requests, total requests)
+        self._hosts = {}
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Sends a request through the shared connection pools, the response content is read before returning."""
+        kwargs.setdefault("timeout", self.timeout_seconds)
+        host = urllib.parse.urlsplit(url).netloc
+        if not host.endswith(GOOGLE_API_HOST_SUFFIX):
+            host = OTHER_HOSTS
+        self._track(host, 1)
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            self._track(host, -1)
+
+    def _track(self, host: str, delta: int):
+        """Updates the in-flight request counts of the host and publishes them as metrics."""
+        with self._lock:
+            in_flight, peak, total = self._hosts.get(host, (0, 0, 0))
+            in_flight += delta
+            if delta > 0:
+                peak = max(peak, in_flight)
+                total += 1
+            self._hosts[host] = (in_flight, peak, total)
+            self._in_flight += delta
+            total_in_flight = self._in_flight
+        metrics.set_gauge("http.in_flight", total_in_flight)
+        metrics.set_gauge(f"http.peak_in_flight.{host}", peak)
+
+    def get_stats(self) -> dict:
+        """Returns the pool utilisation: in-flight requests overall, and per tracked host the in-flight, peak, total requests and open connections."""
+        with self._lock:
+            hosts = { host: { "in_flight": in_flight, "peak_in_flight": peak, "requests": total }
+                      for host, (in_flight, peak, total) in self._hosts.items() }
+            in_flight = self._in_flight
+        for pool_key in list(self.adapter.poolmanager.pools.keys()):
+            pool = self.adapter.poolmanager.pools.get(pool_key)
+            if pool is None:
+                continue
+            host = pool.host if pool.port in (None, 80, 443) else f"{pool.host}:{pool.port}"
+            if host in hosts:
+                hosts[host]["connections"] = pool.num_connections
+        return { "in_flight": in_flight, "pool_maxsize": self.pool_maxsize, "hosts": hosts }
+
+class Httplib2Adapter:
+    """httplib2.Http compatible object that sends requests through the pooled transport.
+
+    It's what Google API discovery clients and google-auth-httplib2 expect, it's shared and must not be closed.
+    """
+
+    def __init__(self, transport: PooledHttpTransport):
+        self.transport = transport
+        self.timeout = transport.timeout_seconds
+        self.redirect_codes = set(httplib2.REDIRECT_CODES)
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=httplib2.DEFAULT_MAX_REDIRECTS, connection_type=None, **kwargs):
+        """Implementation of httplib2's Http.request."""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        try:
+            response = self.transport.request(
+                method,
+                uri,
+                data=body,
+                headers=headers,
+                timeout=self.timeout,
+                allow_redirects=redirections > 0
+            )
+        # Mapped to the built-in errors API clients retry on
+        except requests.exceptions.Timeout as e:
+            raise TimeoutError(str(e)) from e
+        except requests.exceptions.ConnectionError as e:
+            raise ConnectionError(str(e)) from e
+        response_headers = { name.lower(): value for name, value in response.headers.items() }
+        if "content-encoding" in response_headers:
+            # The content is already decoded, like httplib2 does
+            del response_headers["content-encoding"]
+            response_headers["content-length"] = str(len(response.content))
+        response_headers["status"] = str(response.status_code)
+        return httplib2.Response(response_headers), response.content
+
+    def close(self):
+        """Does nothing, connections are shared."""
+        pass
+
+# gRPC channel arguments so that idle connections are kept alive between requests
+GRPC_KEEPALIVE_OPTIONS = [
+    ("grpc.keepalive_time_ms", int(GRPC_KEEPALIVE_TIME_SECONDS * 1000)),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0)
+]
+
+def keepalive_grpc_transport(transport_class):
+    """Returns a callable creating gRPC transports of the given class with keep-alive channels, to pass to gapic clients."""
+    def create_channel(*args, options=(), **kwargs):
+        return transport_class.create_channel(*args, options=[*options, *GRPC_KEEPALIVE_OPTIONS], **kwargs)
+    return functools.partial(transport_class, channel=create_channel)
+
+# Transport singletons
+http_transport = PooledHttpTransport(
+    pool_connections=HTTP_POOL_CONNECTIONS,
+    pool_maxsize=HTTP_POOL_MAXSIZE,
+    timeout_seconds=HTTP_TIMEOUT_SECONDS
+)
+httplib2_adapter = Httplib2Adapter(http_transport)
+# The pool utilisation is included in the metrics reports
+metrics.add_report_source("http_transport", http_transport.get_stats)
@@ -0,0 +1,86 @@
+# Copyright 2025 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Service that handles the suppression of duplicate event deliveries."""
+
+import asyncio
+import metrics
+from typing import Any, Awaitable, Callable
+from cache import IKeyValueStore
+
+# Store values of the deliveries that are still running
+RUNNING = { "status": "running" }
+
+def get_event_idempotency_key(event) -> str:
+    """Returns the key identifying the deliveries of the same Chat event, or None if the event can't be deduplicated."""
+    chat_event = (event or {}).get("chat", {})
+    for payload_name in ["messagePayload", "appCommandPayload"]:
+        message_name = chat_event.get(payload_name, {}).get("message", {}).get("name")
+        if message_name:
+            return f"{payload_name}/{message_name}"
+    return None
+
+class IdempotencyGuard:
+    """Runs a function once per key within a time window, duplicate deliveries don't run it again.
+
+    Duplicates get the result of the first delivery: they wait for it when it's still running in this process,
+    they get the stored result when it's completed, or None when it's running in another process.
+    Failed deliveries are forgotten so that redeliveries are processed.
+    """
+
+    def __init__(self, name: str, store: IKeyValueStore, window_seconds: float):
+        self.name = name
+        self.store = store
+        self.window_seconds = window_seconds
+        # Key -> future of the deliveries running in this process
+        self._in_flight = {}
+
+    async def run(self, key: str, function: Callable[[], Awaitable]) -> Any:
+        """Runs the function unless a delivery with the same key was already received within the window."""
+        if key is None:
+            return await function()
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            print(f"Attaching duplicate delivery {key} to the running one")
+            metrics.increment(f"{self.name}.attached")
+            return await asyncio.shield(in_flight)
+        # Registered before anything is awaited so that concurrent duplicates attach to it
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            if await asyncio.to_thread(self.store.add, key, RUNNING, self.window_seconds):
+                try:
+                    result = await function()
+                except BaseException:
+                    await asyncio.to_thread(self.store.delete, key)
+                    raise
+                stored_result = result if isinstance(result, dict) else None
+                await asyncio.to_thread(self.store.set, key, { "status": "done", "result": stored_result }, self.window_seconds)
+            else:
+                print(f"Suppressing duplicate delivery {key}")
+                metrics.increment(f"{self.name}.suppressed")
+                stored = await asyncio.to_thread(self.store.get, key)
+                result = stored.get("result") if stored else None
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Marks the exception as retrieved when no duplicate is waiting for it
+                future.exception()
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+        future.set_result(result)
+        return result
@@ -0,0 +1,79 @@
+# Copyright 2025 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks the import cost of the project modules, which drives the cold start time of the function.
+
+Each module is imported in a fresh interpreter with `-X importtime`, run:
+
+    python import_benchmark.py --runs 5 --top 15
+
+It reports the median cumulative import time of each project module and the heaviest dependencies of main.
+"""
+
+import argparse
+import glob
+import os
+import statistics
+import subprocess
+import sys
+
+def measure_imports(module: str) -> dict:
+    """Imports the module in a fresh interpreter and returns the cumulative import time in seconds of each module it loaded."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+    timings = {}
+    for line in result.stderr.splitlines():
+        # Format: "import time: self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        timings[name.strip()] = int(cumulative) / 1_000_000
+    return timings
+
+def get_project_modules() -> list:
+    """Returns the names of the project modules, main first."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    names = [os.path.splitext(os.path.basename(path))[0] for path in glob.glob(os.path.join(directory, "*.py"))]
+    names = [name for name in names if not name.endswith("_benchmark")]
+    return sorted(names, key=lambda name: (name != "main", name))
+
+def main():
+    parser = argparse.ArgumentParser(description="Reports the import cost of the project modules.")
+    parser.add_argument("--runs", type=int, default=3, help="number of fresh interpreters per module")
+    parser.add_argument("--top", type=int, default=15, help="number of heaviest dependencies of main to report")
+    args = parser.parse_args()
+
+    main_runs = []
+    print("Cumulative import time of project modules (median):")
+    for module in get_project_modules():
+        runs = [measure_imports(module) for _ in range(args.runs)]
+        if module == "main":
+            main_runs = runs
+        print(f"  {module}: {statistics.median(run[module] for run in runs) * 1000:.1f} ms")
+
+    if main_runs:
+        print("\nHeaviest imports of main (median cumulative time):")
+        names = set.intersection(*[set(run) for run in main_runs]) - { "main" }
+        medians = { name: statistics.median(run[name] for run in main_runs) for name in names }
+        for name, seconds in sorted(medians.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+            print(f"  {name}: {seconds * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    main()
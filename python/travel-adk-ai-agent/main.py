@@ -18,15 +18,82 @@ to listen to HTTP requests from Google Workspace add on events."""
 import asyncio
 import functions_framework
 import jwt
-import json
+import metrics
 from flask import Request, jsonify
-from google_workspace import set_chat_config, find_chat_app_dm, extract_email_contents, get_email, get_person_profile, USERS_PREFIX, SPACES_PREFIX, PEOPLE_PREFIX
+from google_workspace import set_chat_config, find_chat_app_dm, remember_chat_app_dm, invalidate_chat_app_dm, USERS_PREFIX, SPACES_PREFIX
+from host_context import get_available_host_context_providers, build_selected_host_contexts_prompt, fetch_host_context
 from travel_agent_ui_render import TravelAgentUiRender
-from agent_handler import AgentChat, AgentCommon
-from vertex_ai import delete_agent_session, request_agent
-from env import RESET_SESSION_COMMAND_ID, BASE_URL, is_in_debug_mode
+from agent_handler import AgentChat, AgentCommon, merge_chat_messages
+from vertex_ai import delete_agent_session, request_agent, start_reasoning_engine_warm_up
+from event_loop import run_coroutine
+from turn_queue import TurnQueue, create_turn_queue_backend
+from turn_scheduler import TurnScheduler
+from idempotency import IdempotencyGuard, get_event_idempotency_key
+from cache import create_key_value_store
+from env import RESET_SESSION_COMMAND_ID, BASE_URL, TURN_SCHEDULER_POLICY, is_in_debug_mode
+from env import IDEMPOTENCY_STORE, IDEMPOTENCY_WINDOW_SECONDS, IDEMPOTENCY_MAX_SIZE
+from env import CHAT_ASYNC_EXECUTION, CACHE_SQLITE_PATH, TURN_QUEUE_BACKEND, TURN_QUEUE_CONCURRENCY, TURN_QUEUE_LEASE_SECONDS, TURN_QUEUE_MAX_ATTEMPTS, TURN_QUEUE_POLL_SECONDS
 from google.oauth2.credentials import Credentials
 
+async def answer_chat_message(user_name: str, space_name: str, message):
+    """Requests the AI agent to answer the Chat message and uses the Chat handler and UI renderer."""
+    set_chat_config(space_name)
+    await request_agent(user_name, message, AgentChat(TravelAgentUiRender(is_chat=True), space_name=space_name))
+
+async def process_chat_turn(payload: dict):
+    """Processes a Chat turn, the payload contains the user name, the space name and the message."""
+    await answer_chat_message(payload["user_name"], payload["space_name"], payload["message"])
+
+def merge_chat_turns(payloads: list) -> dict:
+    """Merges Chat turns of the same user, the merged turn is answered in the space of the latest one."""
+    return {
+        "user_name": payloads[-1]["user_name"],
+        "space_name": payloads[-1]["space_name"],
+        "message": merge_chat_messages([payload["message"] for payload in payloads])
+    }
+
+# Chat turns of the same user, so that they don't run against the agent session concurrently
+chat_turn_scheduler = TurnScheduler(
+    name="chat_turn_scheduler",
+    policy=TURN_SCHEDULER_POLICY,
+    turn=process_chat_turn,
+    merge=merge_chat_turns
+)
+
+async def schedule_chat_turn(payload: dict):
+    """Processes a Chat turn once the previous turns of the user are handled according to the scheduler policy."""
+    await chat_turn_scheduler.run(payload["user_name"], payload)
+
+# Background queue of Chat turns, used when CHAT_ASYNC_EXECUTION is 1
+chat_turn_queue = TurnQueue(
+    name="chat_turn_queue",
+    backend=create_turn_queue_backend(kind=TURN_QUEUE_BACKEND, table="chat_turn_queue", sqlite_path=CACHE_SQLITE_PATH),
+    handler=schedule_chat_turn,
+    concurrency=TURN_QUEUE_CONCURRENCY,
+    lease_seconds=TURN_QUEUE_LEASE_SECONDS,
+    max_attempts=TURN_QUEUE_MAX_ATTEMPTS,
+    poll_seconds=TURN_QUEUE_POLL_SECONDS,
+    # With the in-process queue, turns of the same user are handed over in order and the scheduler handles their overlap,
+    # the SQLite queue is shared by the worker processes so a user turn only starts once the previous one is completed
+    exclusive_keys=TURN_QUEUE_BACKEND == "sqlite"
+) if CHAT_ASYNC_EXECUTION == 1 else None
+
+# Chat event deliveries already received, Chat redelivers events when the function is slow to respond
+chat_event_guard = IdempotencyGuard(
+    name="chat_event_guard",
+    store=create_key_value_store(kind=IDEMPOTENCY_STORE, table="chat_events", sqlite_path=CACHE_SQLITE_PATH, max_size=IDEMPOTENCY_MAX_SIZE),
+    window_seconds=IDEMPOTENCY_WINDOW_SECONDS
+)
+
+async def deduplicated_adk_ai_agent(request: Request):
+    """Async function triggered by Google Workspace add on events, duplicate Chat event deliveries are only processed once."""
+    key = get_event_idempotency_key(request.get_json(silent=True))
+    if key is None:
+        return await async_adk_ai_agent(request)
+    result = await chat_event_guard.run(key, lambda: async_adk_ai_agent(request))
+    # Duplicates of deliveries running in other processes are only acknowledged
+    return {} if result is None else result
+
 async def async_adk_ai_agent(request: Request):
     """Async function triggered by Google Workspace add on events."""
     request_json = request.get_json(silent=True)
@@ -43,10 +110,21 @@ async def async_adk_ai_agent(request: Request):
 
             if "messagePayload" in chat_event:
                 # Handle message events, actions will be taken via Google Chat API calls
-                set_chat_config(chat_event["messagePayload"]["space"]["name"])
-                # Request AI agent to answer the message and use the Chat handler and UI renderer
-                await request_agent(user_name, chat_event["messagePayload"]["message"], AgentChat(TravelAgentUiRender(is_chat=True)))
-                
+                space_name = chat_event["messagePayload"]["space"]["name"]
+                if chat_event["messagePayload"]["space"].get("singleUserBotDm"):
+                    # Saves a lookup when the user opens the add-on
+                    await asyncio.to_thread(remember_chat_app_dm, user_name, space_name)
+                payload = {
+                    "user_name": user_name,
+                    "space_name": space_name,
+                    "message": chat_event["messagePayload"]["message"]
+                }
+                if CHAT_ASYNC_EXECUTION == 1:
+                    # Hand the turn to the background queue, turns of the same user are handed to the scheduler in order
+                    await chat_turn_queue.enqueue(user_name, payload)
+                else:
+                    await schedule_chat_turn(payload)
+
                 # Respond with an empty response to the Google Chat platform to acknowledge execution
                 return {}
             elif "appCommandPayload" in chat_event:
@@ -60,6 +138,11 @@ async def async_adk_ai_agent(request: Request):
                     return { "hostAppDataAction": { "chatDataAction": { "createMessageAction": { "message": {
                         "text": "OK, let's start from the beginning, what can I help you with?"
                     }}}}}
+            elif "removedFromSpacePayload" in chat_event:
+                # The DM space is deleted when the user removes the app, the next one will be looked up again
+                if chat_event["removedFromSpacePayload"]["space"].get("singleUserBotDm"):
+                    await asyncio.to_thread(invalidate_chat_app_dm, user_name)
+                return {}
         else:
             # Extract auth data from the event
             user_name = USERS_PREFIX + jwt.decode(
@@ -74,37 +157,15 @@ async def async_adk_ai_agent(request: Request):
             if is_in_debug_mode():
                 print(f"Event received: {event}")
 
-            print(f"User found: {user_name}")            
-            space_name = find_chat_app_dm(user_name)
-            print(f"Space found: {space_name}")
-            
-            # Extract contextual, host-specific input
-            # Note; This could be expanded to calendar, drive, docs, sheets, slides
-            host_app_context = []
-            # Fetch and add user profile context
-            person = get_person_profile(
-                credentials=Credentials(token=user_oauth_token),
-                people_name=user_name.replace(USERS_PREFIX, PEOPLE_PREFIX),
-                person_fields="birthdays"
-            )
-            host_app_context.append({ "id": "profile", "name": "Google profile", "value": person })
-            if is_in_debug_mode():
-                print(f"Person: {person}")
-            if "gmail" in event:
-                # Fetch and add current email context if any
-                gmail_event = event["gmail"]
-                if "messageId" in gmail_event:
-                    message = get_email(
-                        credentials=Credentials(token=user_oauth_token),
-                        message_id=gmail_event["messageId"],
-                        addon_event_access_token=gmail_event["accessToken"]
-                    )
-                    host_app_context.append({ "id": "email", "name": "Current email", "value": message })
-                    if is_in_debug_mode():
-                        print(f"Email: {message}")
-                else:
-                    print("No email is currently selected")
-            
+            print(f"User found: {user_name}")
+            # The DM space is fetched while the actions are handled
+            space_name_task = asyncio.create_task(fetch_host_context("space", find_chat_app_dm, user_name=user_name))
+
+            # Only list the contextual, host-specific inputs, they are fetched when selected in the send action
+            host_app_context_providers = get_available_host_context_providers(event)
+            if "gmail" in event and not any(provider.id == "email" for provider in host_app_context_providers):
+                print("No email is currently selected")
+
             # Handles the session reset action
             reset = False
             reset_confirmation_widgets = []
@@ -128,13 +189,13 @@ async def async_adk_ai_agent(request: Request):
                     print(f"Building the AI agent request message...")
                     user_message = "USER MESSAGE TO ANSWER: " + common_event_object['formInputs']['message']['stringInputs']['value'][0]
                     selected_contexts = common_event_object['formInputs']['context']['stringInputs']['value'] if 'context' in common_event_object['formInputs'] else []
-                    if "email" in selected_contexts and any((item['id'] == 'email') for item in host_app_context):
-                        # Include email context if requested by user
-                        email_subject, email_body = extract_email_contents(next(item for item in host_app_context if item['id'] == 'email')["value"])
-                        user_message += f"\n\nEMAIL THE USER HAS OPENED ON SCREEN:\nSubject: {email_subject}\nBody:\n---\n{email_body}\n---"
-                    if "profile" in selected_contexts and any((item['id'] == 'profile') for item in host_app_context):
-                        # Include profile context if requested by user
-                        user_message += f"\n\nPUBLIC PROFILE OF THE USER IN JSON FORMAT: {json.dumps(next(item for item in host_app_context if item['id'] == 'profile')["value"])}"
+                    # Include the contexts requested by user
+                    user_message += await build_selected_host_contexts_prompt(
+                        event=event,
+                        user_name=user_name,
+                        credentials=Credentials(token=user_oauth_token),
+                        selected_ids=selected_contexts
+                    )
                     if is_in_debug_mode():
                         print(f"Answering message: {user_message}...")
                     # Request AI agent to answer the message and use the common handler and UI renderer
@@ -142,16 +203,19 @@ async def async_adk_ai_agent(request: Request):
                     await request_agent(user_name, user_message, travel_common_agent)
                     answer_sections = travel_common_agent.get_answer_sections()
 
+            space_name = await space_name_task
+            print(f"Space found: {space_name}")
+
             # Handles UI card
             host_app_context_sources = { "selectionInput": {
                 "name": "context",
                 "label": "Context",
                 "type": "SWITCH",
-                "items": [{ "text": c["name"], "value": c["id"], "selected": False } for c in host_app_context]
+                "items": [{ "text": p.name, "value": p.id, "selected": False } for p in host_app_context_providers]
             }}
             card = { "sections": [{ "widgets": reset_confirmation_widgets +
                 [{ "textInput": { "name": "message", "label": "Message", "type": "MULTIPLE_LINE" }}] +
-                ([host_app_context_sources] if len(host_app_context) > 0 else []) +
+                ([host_app_context_sources] if len(host_app_context_providers) > 0 else []) +
                 [{ "decoratedText": { "button": {
                     "text": "Send",
                     "type": "FILLED",
@@ -169,7 +233,7 @@ async def async_adk_ai_agent(request: Request):
                     "text": "Open Chat",
                     "type": "OUTLINED",
                     "icon": { "iconUrl": "https://www.gstatic.com/images/branding/productlogos/chat_2023q4/v2/192px.svg"},
-                    "onClick": { "openLink": { "url": f"https://chat.google.com/dm/{space_name.replace(SPACES_PREFIX, "")}" }}
+                    "onClick": { "openLink": { "url": f"https://chat.google.com/dm/{space_name.replace(SPACES_PREFIX, "")}" if space_name else "https://chat.google.com" }}
                 }}}]
             }] + answer_sections }
             if is_in_debug_mode():
@@ -187,8 +251,15 @@ async def async_adk_ai_agent(request: Request):
 @functions_framework.http
 def adk_ai_agent(request: Request):
     """Function triggered by Google Workspace add on events."""
-    # Run the async handler which is required in Google Cloud Functions runtime
-    result = asyncio.run(async_adk_ai_agent(request))
+    # Workers that were not forked warm up on their first request
+    start_reasoning_engine_warm_up()
+    metrics.start_reporting()
+    if chat_turn_queue:
+        # Started on the first request of each worker, so that jobs left by stopped workers are picked up
+        # without waiting for a new Chat message
+        chat_turn_queue.start()
+    # Run the async handler on the event loop of the worker, which is kept between requests
+    result = run_coroutine(deduplicated_adk_ai_agent(request))
     if isinstance(result, dict):
         return jsonify(result)
     elif isinstance(result, tuple) and len(result) == 2:
@@ -0,0 +1,126 @@
+# Copyright 2025 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Service that handles runtime metrics."""
+
+import atexit
+import os
+import threading
+from typing import Callable
+from env import METRICS_REPORT_INTERVAL_SECONDS, is_in_debug_mode
+
+# Aggregated counters, gauges and timings for the process
+_counters = {}
+_gauges = {}
+_timings = {}
+_lock = threading.Lock()
+
+# Optional hook called with (name, value) for each recorded metric, e.g. to export them
+_hook: Callable[[str, float], None] = None
+
+# Name -> function returning stats that are not metrics (e.g. connection pools), included in the reports
+_report_sources = {}
+# Process in which the periodic reports were started
+_reporting_pid = None
+
+def set_metrics_hook(hook: Callable[[str, float], None]):
+    """Sets the hook called for each recorded metric."""
+    global _hook
+    _hook = hook
+
+def increment(name: str, value: int = 1):
+    """Increments the counter with the given name."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+    if _hook:
+        _hook(name, value)
+
+def set_gauge(name: str, value: float):
+    """Sets the current value of the gauge with the given name."""
+    with _lock:
+        _gauges[name] = value
+    if _hook:
+        _hook(name, value)
+
+def record_timing(name: str, seconds: float):
+    """Records a duration in seconds for the timing with the given name."""
+    with _lock:
+        count, total, maximum = _timings.get(name, (0, 0.0, 0.0))
+        _timings[name] = (count + 1, total + seconds, max(maximum, seconds))
+    if _hook:
+        _hook(name, seconds)
+    if is_in_debug_mode():
+        print(f"Timing {name}: {seconds * 1000:.1f} ms")
+
+def get_counter(name: str) -> int:
+    """Returns the current value of the counter with the given name."""
+    with _lock:
+        return _counters.get(name, 0)
+
+def get_ratio(hits_name: str, misses_name: str) -> float:
+    """Returns the ratio of hits over hits and misses, or 0 if nothing was recorded."""
+    with _lock:
+        hits = _counters.get(hits_name, 0)
+        total = hits + _counters.get(misses_name, 0)
+    return hits / total if total > 0 else 0.0
+
+def get_snapshot() -> dict:
+    """Returns a copy of all counters, gauges and timings (count, total and max seconds)."""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "timings": { name: { "count": count, "total": total, "max": maximum } for name, (count, total, maximum) in _timings.items() }
+        }
+
+def add_report_source(name: str, function: Callable[[], dict]):
+    """Includes the stats returned by the function in the reports."""
+    _report_sources[name] = function
+
+def log_report():
+    """Logs all counters, gauges, timings and report sources of the process."""
+    snapshot = get_snapshot()
+    lines = [f"Metrics report of worker {os.getpid()}:"]
+    lines += [f"  {name}: {value}" for name, value in sorted(snapshot["counters"].items())]
+    lines += [f"  {name}: {value:.3f}" for name, value in sorted(snapshot["gauges"].items())]
+    lines += [f"  {name}: {timing['count']} calls, avg {timing['total'] / timing['count'] * 1000:.1f} ms, max {timing['max'] * 1000:.1f} ms"
+              for name, timing in sorted(snapshot["timings"].items())]
+    for name, function in list(_report_sources.items()):
+        try:
+            lines.append(f"  {name}: {function()}")
+        except Exception as e:
+            lines.append(f"  {name}: {repr(e)}")
+    print("\n".join(lines))
+
+def start_reporting():
+    """Starts logging reports at the configured interval, once per worker process."""
+    global _reporting_pid
+    with _lock:
+        if METRICS_REPORT_INTERVAL_SECONDS <= 0 or _reporting_pid == os.getpid():
+            return
+        _reporting_pid = os.getpid()
+    stopped = threading.Event()
+
+    def report_periodically():
+        while not stopped.wait(METRICS_REPORT_INTERVAL_SECONDS):
+            log_report()
+
+    threading.Thread(target=report_periodically, name="metrics-report", daemon=True).start()
+
+def log_final_report():
+    """Logs a last report when a worker that reported metrics stops."""
+    if _reporting_pid == os.getpid():
+        log_report()
+
+atexit.register(log_final_report)
@@ -0,0 +1,105 @@
+# Copyright 2025 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Service that handles the rate limiting of API requests."""
+
+import asyncio
+import threading
+import time
+import metrics
+from collections import OrderedDict
+
+class TokenBucket:
+    """Bucket refilled at a constant rate up to its burst size, each request takes one token."""
+
+    def __init__(self, rate_per_second: float, burst: int):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def reserve(self) -> float:
+        """Takes a token and returns how long to wait before it's available.
+
+        Tokens can be taken in advance, so waiting requests are served in the order they reserved.
+        """
+        now = time.monotonic()
+        self.tokens = min(float(self.burst), self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate_per_second
+
+    def refund(self):
+        """Gives back a token whose request was abandoned."""
+        self.tokens = min(float(self.burst), self.tokens + 1)
+
+class KeyedRateLimiter:
+    """Limits the rate of requests per key (e.g. per Chat space) with one token bucket per key.
+
+    Requests wait for their token instead of failing, the time spent waiting is recorded in the {name}.throttle timing.
+    Requests without a key and limiters with a rate of 0 are not limited.
+    """
+
+    def __init__(self, name: str, rate_per_second: float, burst: int, max_keys: int):
+        self.name = name
+        self.rate_per_second = rate_per_second
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        # Key -> bucket, least recently used first
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _reserve(self, key: str) -> tuple:
+        """Reserves a token of the key bucket and returns the bucket and the wait time."""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate_per_second, self.burst)
+                self._buckets[key] = bucket
+                # Buckets unused for the longest time are likely full anyway
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket, bucket.reserve()
+
+    def _record(self, wait_seconds: float):
+        """Records the throttling of a request."""
+        metrics.increment(f"{self.name}.acquired")
+        if wait_seconds > 0:
+            metrics.increment(f"{self.name}.throttled")
+            metrics.record_timing(f"{self.name}.throttle", wait_seconds)
+
+    def acquire(self, key: str):
+        """Waits in the calling thread until a request can be sent for the key."""
+        if key is None or self.rate_per_second <= 0:
+            return
+        _, wait_seconds = self._reserve(key)
+        self._record(wait_seconds)
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+    async def async_acquire(self, key: str):
+        """Waits without blocking the event loop until a request can be sent for the key."""
+        if key is None or self.rate_per_second <= 0:
+            return
+        bucket, wait_seconds = self._reserve(key)
+        self._record(wait_seconds)
+        if wait_seconds > 0:
+            try:
+                await asyncio.sleep(wait_seconds)
+            except asyncio.CancelledError:
+                with self._lock:
+                    bucket.refund()
+                raise
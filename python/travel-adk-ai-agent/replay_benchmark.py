@@ -0,0 +1,122 @@
+# Copyright 2025 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks the agent event processing offline by replaying recorded agent turns.
+
+Record turns first by setting the AGENT_RECORD_DIR environment variable, then run:
+
+    python replay_benchmark.py RECORDINGS_DIR --handler chat --turns 100 --concurrency 10 --time-scale 0
+
+Chat API writes and image checks are replaced with in-memory fakes that take a fixed latency,
+so that neither Vertex AI nor Google Workspace APIs are called.
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+import agent_handler
+import metrics
+import vertex_ai
+from agent_replay import ReplayAgentEngine
+from travel_agent_ui_render import TravelAgentUiRender
+
+# Session ID used for all benchmark users, it's never sent to Vertex AI
+BENCHMARK_SESSION_ID = "benchmark-session"
+
+def install_fake_apis(api_latency_seconds: float):
+    """Replaces the Chat API writes and image checks with fakes that take the given latency, writes are not rate limited."""
+    def fake_create_message(message, **kwargs) -> str:
+        metrics.increment("benchmark.chat_creates")
+        time.sleep(api_latency_seconds)
+        return f"spaces/benchmark/messages/{uuid.uuid4().hex}"
+
+    def fake_update_message(name: str, message, **kwargs):
+        metrics.increment("benchmark.chat_updates")
+        time.sleep(api_latency_seconds)
+
+    async def fake_async_create_message(message, **kwargs) -> str:
+        metrics.increment("benchmark.chat_creates")
+        await asyncio.sleep(api_latency_seconds)
+        return f"spaces/benchmark/messages/{uuid.uuid4().hex}"
+
+    async def fake_async_update_message(name: str, message, **kwargs):
+        metrics.increment("benchmark.chat_updates")
+        await asyncio.sleep(api_latency_seconds)
+
+    def fake_is_url_image(self, image_url) -> bool:
+        time.sleep(api_latency_seconds)
+        return True
+
+    # All fake messages share one space, its write rate limit would throttle all turns together
+    agent_handler.chat_write_rate_limiter.rate_per_second = 0
+    agent_handler.create_message = fake_create_message
+    agent_handler.update_message = fake_update_message
+    agent_handler.async_create_message = fake_async_create_message
+    agent_handler.async_update_message = fake_async_update_message
+    TravelAgentUiRender.is_url_image = fake_is_url_image
+
+def create_handler(name: str) -> tuple:
+    """Creates the handler to benchmark along with its input."""
+    if name == "chat":
+        return agent_handler.AgentChat(TravelAgentUiRender(is_chat=True)), { "text": "Benchmark" }
+    return agent_handler.AgentCommon(TravelAgentUiRender(is_chat=False)), "Benchmark"
+
+async def run_benchmark(handler_name: str, turns: int, concurrency: int) -> list:
+    """Runs the given number of turns with bounded concurrency and returns their durations."""
+    semaphore = asyncio.Semaphore(concurrency)
+    durations = []
+
+    async def run_turn(index: int):
+        async with semaphore:
+            user_name = f"users/benchmark-{index % concurrency}"
+            vertex_ai.session_id_cache.set(vertex_ai.get_agent_user_pseudo_id(user_name), BENCHMARK_SESSION_ID)
+            handler, input = create_handler(handler_name)
+            start = time.monotonic()
+            await vertex_ai.request_agent(user_name, input, handler)
+            durations.append(time.monotonic() - start)
+
+    await asyncio.gather(*[run_turn(index) for index in range(turns)])
+    return durations
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays recorded agent turns to benchmark event processing.")
+    parser.add_argument("recordings_dir", help="directory containing the recorded JSONL turns")
+    parser.add_argument("--handler", choices=["chat", "common"], default="chat", help="handler to benchmark")
+    parser.add_argument("--turns", type=int, default=50, help="number of turns to replay")
+    parser.add_argument("--concurrency", type=int, default=10, help="number of turns replayed at the same time")
+    parser.add_argument("--time-scale", type=float, default=0.0, help="scale of the recorded delays between events, 0 to disable them")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="latency in seconds of each fake API call")
+    args = parser.parse_args()
+
+    install_fake_apis(args.api_latency)
+    vertex_ai.reasoning_engine_handle.override(ReplayAgentEngine(args.recordings_dir, args.time_scale))
+
+    start = time.monotonic()
+    durations = asyncio.run(run_benchmark(args.handler, args.turns, args.concurrency))
+    elapsed = time.monotonic() - start
+
+    durations.sort()
+    print(f"\nReplayed {len(durations)} turns in {elapsed:.2f}s ({len(durations) / elapsed:.1f} turns/s)")
+    print(f"Turn latency: p50 {statistics.median(durations) * 1000:.1f} ms, "
+          f"p95 {durations[max(0, int(len(durations) * 0.95) - 1)] * 1000:.1f} ms, "
+          f"max {durations[-1] * 1000:.1f} ms")
+    for name, value in metrics.get_snapshot()["counters"].items():
+        print(f"{name}: {value}")
+    for name, timing in metrics.get_snapshot()["timings"].items():
+        print(f"{name}: {timing['count']} calls, avg {timing['total'] / timing['count'] * 1000:.1f} ms, max {timing['max'] * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Copyright 2025 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Service that handles retries of remote calls."""
+
+import random
+import time
+from google.api_core import exceptions as core_exceptions
+from env import MAX_AI_AGENT_RETRIES, AI_AGENT_RETRY_BASE_DELAY_SECONDS, AI_AGENT_RETRY_MAX_DELAY_SECONDS, AI_AGENT_DEADLINE_MARGIN_SECONDS, AI_AGENT_MIN_ATTEMPT_SECONDS, CHAT_APP_TIMEOUT_SECONDS, ADDON_TIMEOUT_SECONDS, CHAT_ASYNC_EXECUTION, CHAT_BACKGROUND_TIMEOUT_SECONDS
+
+# Errors that are worth retrying, others are considered fatal
+RETRYABLE_ERRORS = (
+    core_exceptions.ServiceUnavailable,
+    core_exceptions.DeadlineExceeded,
+    core_exceptions.InternalServerError,
+    core_exceptions.TooManyRequests,
+    core_exceptions.ResourceExhausted,
+    core_exceptions.Aborted,
+    ConnectionError,
+    TimeoutError
+)
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, bounded by a number of attempts and a request deadline.
+
+    Attempts need at least min_attempt_seconds before the deadline to start, callers bound them by the remaining time.
+    """
+
+    def __init__(self, max_attempts: int, base_delay_seconds: float, max_delay_seconds: float, timeout_seconds: float, min_attempt_seconds: float = 0.0):
+        self.max_attempts = max_attempts
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.min_attempt_seconds = min_attempt_seconds
+        self.deadline = time.monotonic() + timeout_seconds
+
+    @classmethod
+    def for_host_app(cls, is_chat: bool) -> "RetryPolicy":
+        """Creates a policy for a new request, with a deadline derived from the host app timeout."""
+        timeout_seconds = CHAT_APP_TIMEOUT_SECONDS if is_chat else ADDON_TIMEOUT_SECONDS
+        if is_chat and CHAT_ASYNC_EXECUTION == 1:
+            # Chat turns run after the event was acknowledged, they are not bound to the Chat timeout
+            timeout_seconds = CHAT_BACKGROUND_TIMEOUT_SECONDS
+        return cls(
+            max_attempts=MAX_AI_AGENT_RETRIES,
+            base_delay_seconds=AI_AGENT_RETRY_BASE_DELAY_SECONDS,
+            max_delay_seconds=AI_AGENT_RETRY_MAX_DELAY_SECONDS,
+            timeout_seconds=timeout_seconds - AI_AGENT_DEADLINE_MARGIN_SECONDS,
+            min_attempt_seconds=AI_AGENT_MIN_ATTEMPT_SECONDS
+        )
+
+    def is_retryable(self, error: Exception) -> bool:
+        """Returns whether the given error is transient and worth retrying."""
+        return isinstance(error, RETRYABLE_ERRORS)
+
+    def remaining_seconds(self) -> float:
+        """Returns the time left before the request deadline."""
+        return self.deadline - time.monotonic()
+
+    def can_start_attempt(self) -> bool:
+        """Returns whether enough time is left before the deadline to start an attempt."""
+        return self.remaining_seconds() >= self.min_attempt_seconds
+
+    def get_delay(self, attempt: int) -> float:
+        """Returns the delay before the next attempt, or None if the attempts or time budget are exhausted."""
+        if attempt >= self.max_attempts:
+            return None
+        delay = random.uniform(0, min(self.max_delay_seconds, self.base_delay_seconds * 2 ** (attempt - 1)))
+        if delay + self.min_attempt_seconds >= self.remaining_seconds():
+            return None
+        return delay
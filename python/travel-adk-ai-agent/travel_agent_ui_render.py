@@ -12,12 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import requests
 import markdown
 import urllib.parse
 import re
 from vertex_ai import IAiAgentUiRender
-from env import is_in_debug_mode, NA_IMAGE_URL
+import requests
+from http_transport import http_transport
+from env import is_in_debug_mode, NA_IMAGE_URL, IMAGE_URL_CHECK_TIMEOUT_SECONDS
 
 class TravelAgentUiRender(IAiAgentUiRender):
     """UI render implementation for the Travel AI Agent."""
@@ -155,5 +156,10 @@ class TravelAgentUiRender(IAiAgentUiRender):
         return [{ "button_list": { "buttons": sourceButtons }}]
 
     def is_url_image(self, image_url):
-        """Checks if a given URL points to an image."""
-        return requests.head(image_url).headers["content-type"] in ["image/png", "image/jpeg", "image/jpg"]
+        """Checks if a given URL points to an image, redirects are not followed."""
+        try:
+            response = http_transport.request("HEAD", image_url, allow_redirects=False, timeout=IMAGE_URL_CHECK_TIMEOUT_SECONDS)
+        except requests.exceptions.RequestException as e:
+            print(f"Could not check image URL {image_url}: {e!r}")
+            return False
+        return response.headers.get("content-type") in ["image/png", "image/jpeg", "image/jpg"]
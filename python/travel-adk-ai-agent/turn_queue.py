@@ -0,0 +1,279 @@
+# Copyright 2025 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Service that handles agent turns executed in the background after the request was acknowledged."""
+
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+import metrics
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable
+from cache import open_sqlite_database
+from event_loop import background_event_loop
+
+class TurnJob:
+    """Agent turn waiting in a queue, jobs with the same key are delivered in order."""
+
+    def __init__(self, id: str, key: str, payload: dict, attempts: int, enqueued_at: float):
+        self.id = id
+        self.key = key
+        self.payload = payload
+        self.attempts = attempts
+        self.enqueued_at = enqueued_at
+
+class ITurnQueueBackend(ABC):
+    """Interface turn queue backends need to implement.
+
+    A leased job is delivered again once its lease expires without being completed (e.g. the worker crashed), so delivery is at-least-once.
+    With exclusive keys only the oldest job of each key can be leased, so jobs of the same key are processed one at a time and in order.
+    Otherwise the next job of a key can be leased once the older ones are leased, so they're handed out in order but can overlap.
+    This is only supported by backends whose jobs are leased by a single process.
+    """
+
+    # Whether the jobs are leased by several processes, e.g. the workers of an instance
+    shared_by_processes = False
+
+    @abstractmethod
+    def put(self, key: str, payload: dict) -> str:
+        """Adds a job and returns its ID."""
+        pass
+
+    @abstractmethod
+    def lease(self, lease_seconds: float, exclusive_keys: bool = True) -> TurnJob:
+        """Leases the oldest available job whose key has no older job (no older job that isn't leased without exclusive keys), or returns None."""
+        pass
+
+    @abstractmethod
+    def extend(self, job_id: str, lease_seconds: float):
+        """Extends the lease of a job that is still being processed."""
+        pass
+
+    @abstractmethod
+    def complete(self, job_id: str):
+        """Removes a processed job."""
+        pass
+
+class InProcessTurnQueueBackend(ITurnQueueBackend):
+    """Turn queue kept in the process memory, jobs are lost on restarts."""
+
+    def __init__(self):
+        # Job ID -> [job, leased until], in enqueue order
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def put(self, key: str, payload: dict) -> str:
+        job = TurnJob(id=uuid.uuid4().hex, key=key, payload=payload, attempts=0, enqueued_at=time.time())
+        with self._lock:
+            self._jobs[job.id] = [job, 0.0]
+        return job.id
+
+    def lease(self, lease_seconds: float, exclusive_keys: bool = True) -> TurnJob:
+        now = time.time()
+        with self._lock:
+            seen_keys = set()
+            for entry in self._jobs.values():
+                job, leased_until = entry
+                if job.key in seen_keys or (not exclusive_keys and leased_until > now):
+                    continue
+                seen_keys.add(job.key)
+                if leased_until <= now:
+                    entry[1] = now + lease_seconds
+                    job.attempts += 1
+                    return job
+        return None
+
+    def extend(self, job_id: str, lease_seconds: float):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id][1] = time.time() + lease_seconds
+
+    def complete(self, job_id: str):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+class SqliteTurnQueueBackend(ITurnQueueBackend):
+    """Turn queue kept in a local SQLite file, jobs survive restarts and are shared by the processes of an instance.
+
+    Keys are always exclusive, as the jobs of a key could otherwise overlap in processes that don't know about each other.
+    """
+
+    shared_by_processes = True
+
+    def __init__(self, path: str, table: str):
+        self.table = table
+        self._connection = open_sqlite_database(path)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL, "
+                "key TEXT NOT NULL, payload TEXT NOT NULL, attempts INTEGER NOT NULL, enqueued_at REAL NOT NULL, "
+                "leased_until REAL NOT NULL)"
+            )
+            self._connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_key ON {table} (key, seq)")
+
+    def put(self, key: str, payload: dict) -> str:
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._connection.execute(
+                f"INSERT INTO {self.table} (id, key, payload, attempts, enqueued_at, leased_until) VALUES (?, ?, ?, 0, ?, 0)",
+                (job_id, key, json.dumps(payload), time.time())
+            )
+        return job_id
+
+    def lease(self, lease_seconds: float, exclusive_keys: bool = True) -> TurnJob:
+        now = time.time()
+        with self._lock:
+            # The immediate transaction prevents other processes from leasing the same job
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute(
+                    f"SELECT id, key, payload, attempts, enqueued_at FROM {self.table} AS job "
+                    f"WHERE seq = (SELECT MIN(seq) FROM {self.table} WHERE key = job.key) AND leased_until <= ? "
+                    "ORDER BY seq LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row is not None:
+                    self._connection.execute(
+                        f"UPDATE {self.table} SET attempts = attempts + 1, leased_until = ? WHERE id = ?",
+                        (now + lease_seconds, row[0])
+                    )
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return TurnJob(id=row[0], key=row[1], payload=json.loads(row[2]), attempts=row[3] + 1, enqueued_at=row[4])
+
+    def extend(self, job_id: str, lease_seconds: float):
+        with self._lock:
+            self._connection.execute(f"UPDATE {self.table} SET leased_until = ? WHERE id = ?", (time.time() + lease_seconds, job_id))
+
+    def complete(self, job_id: str):
+        with self._lock:
+            self._connection.execute(f"DELETE FROM {self.table} WHERE id = ?", (job_id,))
+
+def create_turn_queue_backend(kind: str, table: str, sqlite_path: str) -> ITurnQueueBackend:
+    """Creates a turn queue backend of the given kind, either memory or sqlite."""
+    if kind == "sqlite":
+        return SqliteTurnQueueBackend(path=sqlite_path, table=table)
+    if kind == "memory":
+        return InProcessTurnQueueBackend()
+    raise ValueError(f"Unknown turn queue backend: {kind}")
+
+class TurnQueue:
+    """Dispatches queued agent turns to a handler on the background event loop of the worker.
+
+    Leases are extended while turns are running, jobs delivered more than max_attempts times are dropped.
+    Failed turns are not retried, the handler retries the agent requests and reports failures to the user itself.
+    Without exclusive keys, jobs of the same key are handed to the handler in order without waiting for each other,
+    e.g. when the handler schedules them itself.
+    """
+
+    def __init__(self, name: str, backend: ITurnQueueBackend, handler: Callable[[dict], Awaitable], concurrency: int,
+                 lease_seconds: float, max_attempts: int, poll_seconds: float, exclusive_keys: bool = True):
+        if not exclusive_keys and backend.shared_by_processes:
+            raise ValueError(f"Keys of {name} must be exclusive, its jobs are leased by several processes")
+        self.name = name
+        self.backend = backend
+        self.handler = handler
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_seconds = poll_seconds
+        self.exclusive_keys = exclusive_keys
+        self._dispatcher = None
+        self._dispatcher_pid = None
+        self._wake_up = None
+        self._lock = threading.Lock()
+
+    async def enqueue(self, key: str, payload: dict) -> str:
+        """Adds a turn to the queue and makes sure the dispatcher is running, returns the job ID."""
+        job_id = await asyncio.to_thread(self.backend.put, key, payload)
+        metrics.increment(f"{self.name}.enqueued")
+        self.start()
+        background_event_loop.get_loop().call_soon_threadsafe(self._wake_up.set)
+        return job_id
+
+    def start(self):
+        """Starts the dispatcher on the background event loop if it's not running."""
+        with self._lock:
+            # The dispatcher doesn't survive forks, like the event loop
+            if self._dispatcher is None or self._dispatcher.done() or self._dispatcher_pid != os.getpid():
+                self._wake_up = asyncio.Event()
+                self._dispatcher = background_event_loop.submit(self._dispatch(), daemon=True)
+                self._dispatcher_pid = os.getpid()
+
+    async def _dispatch(self):
+        """Leases jobs while below the concurrency limit and processes them, polls for jobs made available elsewhere."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            await semaphore.acquire()
+            try:
+                job = await asyncio.to_thread(self.backend.lease, self.lease_seconds, self.exclusive_keys)
+            except Exception as e:
+                print(f"Error occurred while leasing {self.name} job: {repr(e)}")
+                job = None
+            if job is None:
+                # Waits for a new job, or polls for jobs of other processes and expired leases
+                semaphore.release()
+                try:
+                    await asyncio.wait_for(self._wake_up.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake_up.clear()
+                continue
+            task = asyncio.create_task(self._process(job))
+            task.add_done_callback(lambda _: semaphore.release())
+
+    async def _process(self, job: TurnJob):
+        """Runs the handler for the job while extending its lease, then completes it whether the turn succeeded or not."""
+        metrics.record_timing(f"{self.name}.wait", max(0.0, time.time() - job.enqueued_at))
+        if job.attempts > self.max_attempts:
+            # The previous deliveries never completed, e.g. the turn keeps crashing the worker
+            print(f"Dropping {self.name} job {job.id} after {job.attempts - 1} attempts")
+            await self._complete(job)
+            metrics.increment(f"{self.name}.dropped")
+            return
+        heartbeat = asyncio.create_task(self._extend_lease(job))
+        try:
+            await self.handler(job.payload)
+            metrics.increment(f"{self.name}.completed")
+        except Exception as e:
+            print(f"Error occurred while processing {self.name} job {job.id}: {repr(e)}")
+            metrics.increment(f"{self.name}.failed")
+        finally:
+            heartbeat.cancel()
+        await self._complete(job)
+
+    async def _complete(self, job: TurnJob):
+        """Removes the job from the backend."""
+        try:
+            await asyncio.to_thread(self.backend.complete, job.id)
+        except Exception as e:
+            # E.g. when the worker is stopping, the job is delivered again once its lease expires
+            print(f"Error occurred while completing {self.name} job {job.id}: {repr(e)}")
+
+    async def _extend_lease(self, job: TurnJob):
+        """Extends the lease of the job periodically until cancelled."""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await asyncio.to_thread(self.backend.extend, job.id, self.lease_seconds)
+            except Exception as e:
+                print(f"Error occurred while extending {self.name} job {job.id} lease: {repr(e)}")
@@ -0,0 +1,113 @@
+# Copyright 2025 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Service that handles the scheduling of concurrent agent turns of the same user."""
+
+import asyncio
+import time
+import metrics
+from typing import Any, Awaitable, Callable
+
+# Turns wait for the previous turns of the user to complete
+QUEUE_POLICY = "queue"
+# Turns cancel the previous turns of the user, running or waiting
+SUPERSEDE_POLICY = "supersede"
+# Turns received while a turn of the user is running are merged into the next turn
+MERGE_POLICY = "merge"
+
+class TurnBatch:
+    """Inputs answered by the same turn, a single one unless they're merged."""
+
+    def __init__(self, input):
+        self.inputs = [input]
+        self.task = None
+
+class UserTurns:
+    """Turns of a user that are running or waiting in this process."""
+
+    def __init__(self):
+        self.tasks = set()
+        # Batch that didn't start yet and still accepts inputs with the merge policy
+        self.open_batch = None
+
+class TurnScheduler:
+    """Runs at most one turn per user at a time, concurrent turns are handled according to the policy.
+
+    Turns of a user run against the same agent session, running them concurrently mixes up the session events.
+    Superseded turns are cancelled, the turn function is expected to finalize its outputs when cancelled.
+    Note: With agent engines that only stream synchronously, the superseded remote run goes on until its next event.
+    Turns are only scheduled within the process, e.g. turns received by different instances can still overlap.
+    """
+
+    def __init__(self, name: str, policy: str, turn: Callable[[Any], Awaitable], merge: Callable[[list], Any]):
+        if policy not in [QUEUE_POLICY, SUPERSEDE_POLICY, MERGE_POLICY]:
+            raise ValueError(f"Unknown turn scheduler policy: {policy}")
+        self.name = name
+        self.policy = policy
+        self.turn = turn
+        self.merge = merge
+        # User key -> turns of the user
+        self._users = {}
+
+    async def run(self, key: str, input) -> Any:
+        """Schedules a turn for the input and returns its result, or None if it got superseded."""
+        user_turns = self._users.setdefault(key, UserTurns())
+        batch = user_turns.open_batch
+        if batch is not None:
+            # Joins the turn that will run next, all its callers get its result
+            batch.inputs.append(input)
+            metrics.increment(f"{self.name}.merged")
+        else:
+            previous_tasks = list(user_turns.tasks)
+            if self.policy == SUPERSEDE_POLICY:
+                for task in previous_tasks:
+                    # Turns already being cancelled are left to finalize their outputs
+                    if task.cancelling() == 0:
+                        task.cancel()
+                        metrics.increment(f"{self.name}.superseded")
+            batch = TurnBatch(input)
+            batch.task = asyncio.create_task(self._run_after(user_turns, previous_tasks, batch))
+            user_turns.tasks.add(batch.task)
+            batch.task.add_done_callback(lambda task: self._forget(key, user_turns, task))
+            if self.policy == MERGE_POLICY and previous_tasks:
+                user_turns.open_batch = batch
+        try:
+            # Shielded so that the turn isn't cancelled along with one of the callers sharing it
+            return await asyncio.shield(batch.task)
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling() > 0:
+                raise
+            print(f"Turn of {key} was superseded by a newer one")
+            return None
+
+    async def _run_after(self, user_turns: UserTurns, previous_tasks: list, batch: TurnBatch) -> Any:
+        """Waits for the previous turns of the user to complete, then runs the turn for the batch inputs."""
+        if previous_tasks:
+            start = time.time()
+            await asyncio.wait(previous_tasks)
+            metrics.record_timing(f"{self.name}.wait", time.time() - start)
+        if user_turns.open_batch is batch:
+            # Inputs received from now on are answered by the next turn
+            user_turns.open_batch = None
+        input = batch.inputs[0] if len(batch.inputs) == 1 else self.merge(batch.inputs)
+        return await self.turn(input)
+
+    def _forget(self, key: str, user_turns: UserTurns, task: asyncio.Task):
+        """Removes a completed turn, and the user once all its turns completed."""
+        user_turns.tasks.discard(task)
+        if not user_turns.tasks and self._users.get(key) is user_turns:
+            del self._users[key]
+        # Marks the exception as retrieved, it's raised to the callers
+        if not task.cancelled():
+            task.exception()
@@ -14,11 +14,20 @@
 
 """Service that handles Vertex AI API operations."""
 
+import asyncio
+import functools
+import inspect
 import json
-from google.adk.sessions import VertexAiSessionService
-from vertexai import agent_engines
-from env import PROJECT_NUMBER, LOCATION, ENGINE_ID, MAX_AI_AGENT_RETRIES
+import os
+import threading
+import time
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from env import PROJECT_NUMBER, LOCATION, ENGINE_ID, SESSION_CACHE_MAX_SIZE, SESSION_CACHE_TTL_SECONDS, AGENT_ENGINE_MAX_AGE_SECONDS, AGENT_ENGINE_WARM_UP, AGENT_EVENT_QUEUE_SIZE, AGENT_HANDLER_CONCURRENCY, AGENT_STREAM_READER_THREADS, AGENT_RECORD_DIR, AGENT_REPLAY_DIR, AGENT_REPLAY_TIME_SCALE
 from google_workspace import USERS_PREFIX
+from cache import TtlLruCache
+from retry_policy import RetryPolicy
+from agent_replay import AgentEventRecorder, ReplayAgentEngine
 from abc import ABC, abstractmethod
 from env import is_in_debug_mode
 from typing import Any
@@ -28,27 +37,50 @@ REASONING_ENGINE = f"projects/{PROJECT_NUMBER}/locations/{LOCATION}/reasoningEng
 
 # ------- Session management
 
-# Session service client instance singleton
-session_service = VertexAiSessionService(PROJECT_NUMBER, LOCATION)
+@functools.cache
+def get_session_service():
+    """Returns the session service client singleton, created on first use to keep cold starts short."""
+    # The ADK is imported lazily as it's the largest part of the module import time
+    from google.adk.sessions import VertexAiSessionService
+    return VertexAiSessionService(PROJECT_NUMBER, LOCATION)
+
+# Session ID cache keyed by user pseudo ID, avoids listing sessions on every turn
+session_id_cache = TtlLruCache(name="session_id", max_size=SESSION_CACHE_MAX_SIZE, ttl_seconds=SESSION_CACHE_TTL_SECONDS)
 
 def get_agent_user_pseudo_id(userName) -> str:
     """Extracts the pseudo user ID from the full user resource name."""
     return userName.replace(USERS_PREFIX, '')
 
+def evict_agent_session(userName):
+    """Removes the cached agent session ID associated with the given user."""
+    session_id_cache.delete(get_agent_user_pseudo_id(userName))
+
+def is_session_not_found_error(error: Exception) -> bool:
+    """Returns whether the given error indicates that the agent session no longer exists."""
+    message = str(error).lower()
+    return "session" in message and ("not found" in message or "not_found" in message)
+
 async def delete_agent_session(userName) -> str:
     """Deletes the agent session associated with the given user."""
     session_id = await get_agent_session(userName)
+    evict_agent_session(userName)
     if session_id != None:
         print(f"Deleting session {session_id}...")
-        return await session_service.delete_session(app_name=REASONING_ENGINE, user_id=get_agent_user_pseudo_id(userName), session_id=session_id)
+        return await get_session_service().delete_session(app_name=REASONING_ENGINE, user_id=get_agent_user_pseudo_id(userName), session_id=session_id)
     print(f"No session found for {userName}, nothing to delete")
 
 async def get_agent_session(userName) -> str:
     """Retrieves the agent session associated with the given user."""
-    listSessions = await session_service.list_sessions(app_name=REASONING_ENGINE, user_id=get_agent_user_pseudo_id(userName))
+    user_id = get_agent_user_pseudo_id(userName)
+    session_id = session_id_cache.get(user_id)
+    if session_id != None:
+        print(f"Found cached session: {session_id}")
+        return session_id
+    listSessions = await get_session_service().list_sessions(app_name=REASONING_ENGINE, user_id=user_id)
     if listSessions and len(listSessions.sessions) > 0:
         # Return the first session found
         print(f"Found existing session: {listSessions.sessions[0].id}")
+        session_id_cache.set(user_id, listSessions.sessions[0].id)
         return listSessions.sessions[0].id
     return None
 
@@ -57,11 +89,101 @@ async def get_or_create_agent_session(userName) -> str:
     session_id = await get_agent_session(userName)
     if session_id == None:
         # Create a new session
-        session = await session_service.create_session(app_name=REASONING_ENGINE, user_id=get_agent_user_pseudo_id(userName))
+        session = await get_session_service().create_session(app_name=REASONING_ENGINE, user_id=get_agent_user_pseudo_id(userName))
         session_id = session.id
+        session_id_cache.set(get_agent_user_pseudo_id(userName), session_id)
         print(f"Created new session: {session_id}")
     return session_id
 
+# ------- Reasoning engine handle
+
+class ReasoningEngineHandle:
+    """Process-wide, lazily initialized and thread-safe handle to the remote reasoning engine."""
+
+    def __init__(self, resource_name: str, max_age_seconds: int):
+        self.resource_name = resource_name
+        self.max_age_seconds = max_age_seconds
+        self._engine = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        # A fork can happen while another thread fetches the engine, the lock would then stay held in the child
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        """Replaces the lock in forked processes, where the thread that may have held it doesn't exist."""
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns the engine, fetching it if missing or older than the configured max age."""
+        with self._lock:
+            if self._engine is None or time.monotonic() - self._fetched_at > self.max_age_seconds:
+                print(f"Fetching remote agent: {self.resource_name}...")
+                start = time.monotonic()
+                # Vertex AI is imported lazily as it's the largest part of the module import time
+                from vertexai import agent_engines
+                self._engine = agent_engines.get(self.resource_name)
+                self._fetched_at = time.monotonic()
+                metrics.record_timing("agent_engine.lookup", self._fetched_at - start)
+            return self._engine
+
+    def invalidate(self):
+        """Drops the engine so that the next call fetches it again."""
+        with self._lock:
+            if self.max_age_seconds != float("inf"):
+                self._engine = None
+
+    def override(self, engine):
+        """Replaces the remote engine with the given one for the lifetime of the process, e.g. to replay recordings."""
+        with self._lock:
+            self._engine = engine
+            self.max_age_seconds = float("inf")
+
+def is_stale_engine_error(error: Exception) -> bool:
+    """Returns whether the given error indicates that the engine handle should be refreshed."""
+    if type(error).__name__ in ["NotFound", "Unauthenticated", "RefreshError"]:
+        return True
+    message = str(error).lower()
+    return "reasoning engine" in message and ("not found" in message or "not_found" in message)
+
+# Engine handle instance singleton
+reasoning_engine_handle = ReasoningEngineHandle(REASONING_ENGINE, AGENT_ENGINE_MAX_AGE_SECONDS)
+
+if AGENT_REPLAY_DIR:
+    print(f"Replaying recorded agent events from {AGENT_REPLAY_DIR}...")
+    reasoning_engine_handle.override(ReplayAgentEngine(AGENT_REPLAY_DIR, AGENT_REPLAY_TIME_SCALE))
+
+def warm_up_reasoning_engine():
+    """Fetches the engine and creates the session service ahead of the first request, failures are left to the request path."""
+    try:
+        reasoning_engine_handle.get()
+        get_session_service()
+    except Exception as e:
+        print(f"Error occurred while warming up the agent engine: {e}")
+
+# Process in which the warm-up was started
+_warm_up_pid = None
+_warm_up_lock = threading.Lock()
+
+def start_reasoning_engine_warm_up():
+    """Imports Vertex AI and the ADK and fetches the engine in the background, once per worker process."""
+    global _warm_up_pid
+    if AGENT_ENGINE_WARM_UP != 1:
+        return
+    with _warm_up_lock:
+        if _warm_up_pid == os.getpid():
+            return
+        _warm_up_pid = os.getpid()
+    threading.Thread(target=warm_up_reasoning_engine, daemon=True).start()
+
+def start_reasoning_engine_warm_up_after_fork():
+    """Starts the warm-up in forked worker processes, the process importing the app may only fork them."""
+    global _warm_up_lock
+    _warm_up_lock = threading.Lock()
+    start_reasoning_engine_warm_up()
+
+# Not started at import time, as a fork during the warm-up would leave its locks and imports half-done in the worker
+os.register_at_fork(after_in_child=start_reasoning_engine_warm_up_after_fork)
+
 # ------- Agent request handling
 
 class IAiAgentUiRender(ABC):
@@ -93,8 +215,16 @@ class IAiAgentUiRender(ABC):
         """Returns the widgets to render for a given agent response."""
         pass
 
+def inline_handler(function):
+    """Marks a synchronous handler function as cheap enough to be called on the event loop rather than in a worker thread."""
+    function.inline = True
+    return function
+
 class IAiAgentHandler(ABC):
-    """Interface AI Agent handlers need to implement."""
+    """Interface AI Agent handlers need to implement.
+
+    Functions can be implemented as coroutines, synchronous ones are run in a worker thread.
+    """
     
     ui_render: IAiAgentUiRender
     
@@ -125,98 +255,301 @@ class IAiAgentHandler(ABC):
     def function_calling_failure(self, name: str, output_id: str):
         """Handles the failure of a function calling from the agent."""
         pass
+
+    async def function_calling_cancellation(self, name: str, output_id: str):
+        """Handles a function calling that was still ongoing when the agent turn got cancelled, reported as a failure by default."""
+        await call_handler(self.function_calling_failure, name=name, output_id=output_id)
+
+    @inline_handler
+    def complete_turn(self):
+        """Handles the end of the agent turn, e.g. to send outputs that are still pending."""
+        pass
         
+# ------- Non-blocking agent streaming
+
+# Marks the end of the agent event stream in the read-ahead queue
+_END_OF_STREAM = object()
+
+# Worker threads reading synchronous agent streams, one per running turn, kept apart from the default executor
+# so that readers waiting for a full queue can't starve the handler calls that drain it
+agent_stream_executor = ThreadPoolExecutor(max_workers=AGENT_STREAM_READER_THREADS, thread_name_prefix="agent-stream")
+
+async def call_handler(function, **kwargs):
+    """Calls a handler function, running synchronous ones in a worker thread to keep the event loop free unless they're inline."""
+    if inspect.iscoroutinefunction(function):
+        return await function(**kwargs)
+    if getattr(function, "inline", False):
+        return function(**kwargs)
+    return await asyncio.to_thread(function, **kwargs)
+
+async def stream_agent_events(ai_agent, **kwargs):
+    """Streams raw agent events through a bounded queue, reading ahead while the caller processes events."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=AGENT_EVENT_QUEUE_SIZE)
+    stopped = threading.Event()
+
+    def read_sync():
+        """Bridges the synchronous stream, blocking the worker thread while the queue is full.
+
+        Note: A stopped stream can only be closed once the thread gets control back, e.g. when the next event arrives,
+        so the remote run goes on until then.
+        """
+        events = ai_agent.stream_query(**kwargs)
+        try:
+            for event in events:
+                if stopped.is_set():
+                    break
+                asyncio.run_coroutine_threadsafe(queue.put(event), loop).result()
+        finally:
+            # Closes the underlying response of the stream right away instead of when it's garbage collected
+            if hasattr(events, "close"):
+                events.close()
+
+    async def produce():
+        """Reads the agent stream into the queue, using the async stream API when available."""
+        try:
+            if hasattr(ai_agent, "async_stream_query"):
+                async for event in ai_agent.async_stream_query(**kwargs):
+                    await queue.put(event)
+            else:
+                await loop.run_in_executor(agent_stream_executor, read_sync)
+            await queue.put(_END_OF_STREAM)
+        except Exception as e:
+            await queue.put(e)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (item := await queue.get()) is not _END_OF_STREAM:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Stop reading and unblock the producer if the consumer stopped early
+        stopped.set()
+        producer.cancel()
+        while not queue.empty():
+            queue.get_nowait()
+
+class HandlerEffects:
+    """Runs handler side effects as concurrent tasks while keeping the outputs in the agent order."""
+
+    def __init__(self, max_concurrency: int):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._last_create_task = None
+        self._tasks = []
+
+    async def create(self, function, **kwargs) -> asyncio.Task:
+        """Schedules a handler call that creates an output, after all previously scheduled creations."""
+        previous_task = self._last_create_task
+        async def run():
+            if previous_task:
+                # Only the order matters here, failures are reported by join
+                await asyncio.wait([previous_task])
+            return await call_handler(function, **kwargs)
+        self._last_create_task = await self._schedule(run())
+        return self._last_create_task
+
+    async def update(self, output_task: asyncio.Task, function, **kwargs) -> asyncio.Task:
+        """Schedules a handler call that updates the output created by the given task."""
+        async def run():
+            output_id = await output_task if output_task else None
+            return await call_handler(function, output_id=output_id, **kwargs)
+        return await self._schedule(run())
+
+    async def join(self):
+        """Waits for all scheduled handler calls and raises the first failure if any."""
+        results = await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise errors[0]
+
+    async def _schedule(self, coroutine) -> asyncio.Task:
+        """Starts the coroutine as a task, waiting while too many handler calls are in flight."""
+        await self._semaphore.acquire()
+        task = asyncio.create_task(coroutine)
+        task.add_done_callback(lambda _: self._semaphore.release())
+        self._tasks.append(task)
+        return task
+
+# ------- Agent request
+
 async def request_agent(userName: str, input, handler: IAiAgentHandler):
     """Sends a request to the AI agent and processes the response using the given handler."""
+    # Keep track of the mapping between function call IDs and output creation tasks
+    function_call_output_map = {}
+    # Keep track of the mapping between function call IDs and agents
+    function_call_output_agent_map = {}
+    # Keep track of ongoing function calls
+    function_call_ongoing_ids = []
+    # Handler side effects run concurrently with the agent stream
+    effects = HandlerEffects(AGENT_HANDLER_CONCURRENCY)
+    # Raw agent events are written to one file per turn when recording is enabled
+    recorder = AgentEventRecorder(AGENT_RECORD_DIR, get_agent_user_pseudo_id(userName)) if AGENT_RECORD_DIR else None
+
+    async def settle_ongoing_outputs(function):
+        """Waits for the pending handler calls, then updates the outputs of ongoing function calls with the given handler function."""
+        try:
+            await effects.join()
+        except Exception as effect_error:
+            print(f"Error occurred while handling agent outputs: {effect_error}")
+        for id in list(function_call_ongoing_ids):
+            output_task = function_call_output_map.get(id)
+            if output_task and not output_task.cancelled() and output_task.exception() is None:
+                await effects.update(output_task, function, name=function_call_output_agent_map.get(id))
+            function_call_ongoing_ids.remove(id)
+
+    async def process_event(event_raw):
+        """Dispatches a single agent event to the handler."""
+        event = dict(event_raw)
+        if is_in_debug_mode():
+            print(f"Event: {json.dumps(event)}")
+
+        # Retrieve the agent responsible for generating the content
+        author = event["author"]
+
+        # Ignore events that are not useful for the end-user
+        if "content" not in event:
+            print(f"\n{author}: internal event")
+            return
+
+        # Retrieve function calls and responses
+        function_calls = [e["function_call"] for e in event["content"]["parts"] if "function_call" in e]
+        function_responses = [e["function_response"] for e in event["content"]["parts"] if "function_response" in e]
+
+        # Handle final answer
+        if "text" in event["content"]["parts"][0]:
+            text = event["content"]["parts"][0]["text"]
+            print(f"\n{author}: {text}")
+            await effects.create(handler.final_answer, author=author, text=text, success=True, failure=False)
+
+        # Handle agent funtion calling initiation
+        if function_calls:
+            for function_call in function_calls:
+                id = function_call["id"]
+                name = function_call["name"]
+                # Skip internal function calls
+                if name != "transfer_to_agent" and name not in handler.ui_render.ignored_authors():
+                    print(f"\n{author}: function calling initiation {name}")
+                    function_call_output_map[id] = await effects.create(handler.function_calling_initiation, author=author, name=name)
+                    function_call_output_agent_map[id] = name
+                    function_call_ongoing_ids.append(id)
+                else:
+                    print(f"\n{author}: internal event, function calling initiation {name}")
+
+        # Handle agent function calling completion
+        elif function_responses:
+            for function_response in function_responses:
+                id = function_response["id"]
+                name = function_response["name"]
+                response = function_response["response"]
+                # Skip internal function calls
+                if name != "transfer_to_agent" and name not in handler.ui_render.ignored_authors():
+                    print(f'\n{author}: function calling completion {name}')
+                    if is_in_debug_mode():
+                        print(f'Function calling response: {json.dumps(response, indent=2)}')
+                    # The output ID is resolved once the initiation output is created
+                    await effects.update(function_call_output_map.get(id), handler.function_calling_completion, author=author, name=name, response=response)
+                    function_call_ongoing_ids.remove(id)
+                else:
+                    print(f"\n{author}: internal event, completed transfer")
+
     try:
         print("Initializing the session...")
         session_id = await get_or_create_agent_session(userName)
 
         print(f"Requesting remote agent: {REASONING_ENGINE}...")
-        ai_agent = agent_engines.get(REASONING_ENGINE)
-        # Keep track of the mapping between function call IDs and output resource IDs
-        function_call_output_map = {}
-        # Keep track of the mapping between function call IDs and agents
-        function_call_output_agent_map = {}
-        # Keep track of ongoing function calls
-        function_call_ongoing_ids = []
+        ai_agent = await asyncio.to_thread(reasoning_engine_handle.get)
+        message = await call_handler(handler.extract_content_from_input, input=input)
+        retry_policy = RetryPolicy.for_host_app(is_chat=handler.ui_render.is_chat)
         attempt = 0
         responded = False
-        # Retry loop in case of no response from the agent
-        while attempt < MAX_AI_AGENT_RETRIES and not responded:
+        # The cached session can be deleted by other workers (e.g. on reset), it's looked up again once per turn
+        session_refreshed = False
+        # Retry loop in case of no response or a transient error from the agent
+        while not responded:
+            if not retry_policy.can_start_attempt():
+                raise TimeoutError(f"Not enough time left for an agent request, {retry_policy.remaining_seconds():.1f}s left")
             attempt += 1
-            print(f"Attempting agent request #{attempt} / {MAX_AI_AGENT_RETRIES}...")
-            # Stream the agent response
-            for event_raw in ai_agent.stream_query(user_id=get_agent_user_pseudo_id(userName), session_id=session_id, message=handler.extract_content_from_input(input=input)):
-                responded = True
-                event = dict(event_raw)
-                if is_in_debug_mode():
-                    print(f"Event: {json.dumps(event)}")
-
-                # Retrieve the agent responsible for generating the content
-                author = event["author"]
-
-                # Ignore events that are not useful for the end-user
-                if "content" not in event:
-                    print(f"\n{author}: internal event")
+            print(f"Attempting agent request #{attempt} / {retry_policy.max_attempts}, {retry_policy.remaining_seconds():.1f}s left...")
+            attempt_start = time.monotonic()
+            error = None
+            try:
+                # Stream the agent response, the attempt is stopped if it didn't respond by the request deadline
+                async with asyncio.timeout(retry_policy.remaining_seconds()) as attempt_timeout:
+                    async for event_raw in stream_agent_events(ai_agent, user_id=get_agent_user_pseudo_id(userName), session_id=session_id, message=message):
+                        if not responded and handler.ui_render.is_chat:
+                            # Chat answers are sent through the API, they can keep streaming after the host app timeout
+                            attempt_timeout.reschedule(None)
+                        responded = True
+                        if recorder:
+                            recorder.record(event_raw)
+                        await process_event(event_raw)
+            except Exception as e:
+                if not responded and not session_refreshed and is_session_not_found_error(e):
+                    print(f"Session {session_id} not found, retrying with a fresh session for {userName}")
+                    metrics.increment("agent.session_refreshed")
+                    evict_agent_session(userName)
+                    session_id = await get_or_create_agent_session(userName)
+                    session_refreshed = True
                     continue
-
-                # Retrieve function calls and responses
-                function_calls = [e["function_call"] for e in event["content"]["parts"] if "function_call" in e]
-                function_responses = [e["function_response"] for e in event["content"]["parts"] if "function_response" in e]
-
-                # Handle final answer
-                if "text" in event["content"]["parts"][0]:
-                    text = event["content"]["parts"][0]["text"]
-                    print(f"\n{author}: {text}")
-                    handler.final_answer(author=author, text=text, success=True, failure=False)
-
-                # Handle agent funtion calling initiation
-                if function_calls:
-                    for function_call in function_calls:
-                        id = function_call["id"]
-                        name = function_call["name"]
-                        # Skip internal function calls
-                        if name != "transfer_to_agent" and name not in handler.ui_render.ignored_authors():
-                            print(f"\n{author}: function calling initiation {name}")
-                            function_call_output_map[id] = handler.function_calling_initiation(author=author, name=name)
-                            function_call_output_agent_map[id] = name
-                            function_call_ongoing_ids.append(id)
-                        else:
-                            print(f"\n{author}: internal event, function calling initiation {name}")
-
-                # Handle agent function calling completion
-                elif function_responses:
-                    for function_response in function_responses:
-                        id = function_response["id"]
-                        name = function_response["name"]
-                        response = function_response["response"]
-                        # Skip internal function calls
-                        if name != "transfer_to_agent" and name not in handler.ui_render.ignored_authors():
-                            # Retrieve the output resource ID for the function call
-                            output_id = function_call_output_map.get(id)
-                            print(f'\n{author}: function calling completion {name}')
-                            if is_in_debug_mode():
-                                print(f'Function calling response: {json.dumps(response, indent=2)}')
-                            handler.function_calling_completion(author=author, name=name, response=response, output_id=output_id)
-                            function_call_ongoing_ids.remove(id)
-                        else:
-                            print(f"\n{author}: internal event, completed transfer")
-
-            print("Agent responded to the request." if responded is True else "No response received from the agent.")
+                # Retrying after a partial response would duplicate outputs
+                if responded or not retry_policy.is_retryable(e):
+                    raise
+                error = e
+            attempt_duration = time.monotonic() - attempt_start
+            metrics.record_timing("agent.attempt", attempt_duration)
+            print(f"Agent request #{attempt} took {attempt_duration:.2f}s")
+            if responded:
+                print("Agent responded to the request.")
+                break
+            print("No response received from the agent." if error is None else f"Retryable error from the agent: {repr(error)}")
+            delay = retry_policy.get_delay(attempt)
+            if delay is None:
+                print("No more agent request attempts allowed.")
+                if error is not None:
+                    raise error
+                break
+            print(f"Retrying agent request in {delay:.2f}s...")
+            await asyncio.sleep(delay)
+        await effects.join()
+        await call_handler(handler.complete_turn)
+    except asyncio.CancelledError:
+        # The turn was superseded, ongoing outputs are finalized instead of being left in progress
+        print(f"Agent request cancelled for {userName}")
+        metrics.increment("agent.cancelled")
+        await settle_ongoing_outputs(handler.function_calling_cancellation)
+        try:
+            await effects.join()
+            await call_handler(handler.complete_turn)
+        except Exception as effect_error:
+            print(f"Error occurred while reporting the agent cancellation: {effect_error}")
+        raise
     except Exception as e:
-        print(f"Error occurred while requesting AI agent: {e}")
+        print(f"Error occurred while requesting AI agent: {repr(e)}")
+        if is_session_not_found_error(e):
+            # The session is still missing after a refresh, next turn will look it up again
+            print(f"Session not found, evicting cached session for {userName}")
+            evict_agent_session(userName)
+        if is_stale_engine_error(e):
+            # The engine handle is stale, next turn will fetch it again
+            print("Stale agent engine, invalidating handle")
+            reasoning_engine_handle.invalidate()
         # Update all ongoing agent outputs with a failure status
-        for id in function_call_ongoing_ids:
-            handler.function_calling_failure(
-                name=function_call_output_agent_map.get(id),
-                output_id=function_call_output_map.get(id)
-            )
-            function_call_ongoing_ids.remove(id)
+        await settle_ongoing_outputs(handler.function_calling_failure)
         # Send a final answer indicating the failure
-        handler.final_answer(
+        await effects.create(
+            handler.final_answer,
             author="Agent",
             text="Something went wrong, I could not answer that specific question. Please try again later.",
             success=False,
             failure=True
         )
+        try:
+            await effects.join()
+            await call_handler(handler.complete_turn)
+        except Exception as effect_error:
+            print(f"Error occurred while reporting the agent failure: {effect_error}")
+    finally:
+        if recorder:
+            recorder.close()